@@ -0,0 +1,182 @@
+import heapq
+import json
+import os
+import numpy as np
+from pytagmapper.map_builder import MapBuilder
+from pytagmapper.project import get_corners_mat
+
+# the full state of a MapBuilder in one compressed .npz
+#
+# poses, detections with their linearizations, messages, beliefs,
+# residual schedule and regularizer (with the priors that have not been
+# synced into the beliefs yet) are all saved, so a MapBuilder loaded
+# from a checkpoint carries on exactly like the one that was saved. the
+# bookkeeping (tag_detections, corners_mats, id lookups) is rebuilt
+# on load
+#
+# extra is anything json serializable that the caller wants to keep
+# with the map, eg the viewpoints still to be added
+#
+#   save_checkpoint("checkpoint.npz", map_builder, { 'viewpoint_order': ... })
+#   map_builder, extra = load_checkpoint("checkpoint.npz")
+
+CHECKPOINT_VERSION = 2
+
+def get_info_pools(map_builder):
+    return {
+        'detection_to_tag_msgs': map_builder.detection_to_tag_msgs,
+        'detection_to_viewpoint_msgs': map_builder.detection_to_viewpoint_msgs,
+        'viewpoint_infos': map_builder.viewpoint_infos,
+        'tag_infos': map_builder.tag_infos,
+    }
+
+def save_checkpoint(path, map_builder, extra = None):
+    meta = {
+        'version': CHECKPOINT_VERSION,
+        'map_type': map_builder.map_type,
+        # as pairs, json would turn integer tag ids into strings
+        'tag_side_lengths': list(map_builder.tag_side_lengths.items()),
+        'robust_kernel': map_builder.robust_kernel,
+        'message_passing': map_builder.message_passing,
+        'solver': map_builder.solver,
+        'scheduling': map_builder.scheduling,
+        'gauge': map_builder.gauge,
+        'lm_linear_solver': map_builder.lm_linear_solver,
+        'schedule_threshold': map_builder.schedule_threshold,
+        'huber_k': map_builder.huber_k,
+        'inverse_pixel_cov': map_builder.inverse_pixel_cov,
+        'regularizer': map_builder.regularizer,
+        'streak': map_builder.streak,
+        'viewpoint_ids': list(map_builder.viewpoint_ids),
+        'tag_ids': list(map_builder.tag_ids),
+        'extra': extra or {},
+    }
+
+    arrays = {
+        'meta': np.array(json.dumps(meta)),
+        'camera_matrix': map_builder.camera_matrix,
+        'txs_world_viewpoint': map_builder.viewpoint_poses.array,
+        'txs_world_tag': map_builder.tag_poses.array,
+        'viewpoint_detections': np.array(map_builder.viewpoint_detections, dtype=np.int64).reshape((-1,2)),
+        'viewpoint_residuals': np.array(map_builder.viewpoint_residuals, dtype=np.float64),
+        'tag_residuals': np.array(map_builder.tag_residuals, dtype=np.float64),
+        'viewpoint_priors': np.array(map_builder.viewpoint_priors, dtype=np.float64),
+        'tag_priors': np.array(map_builder.tag_priors, dtype=np.float64),
+    }
+    store = map_builder.detection_store
+    for field in store.fields:
+        arrays['detections.' + field] = getattr(store, field)
+    for name, pool in get_info_pools(map_builder).items():
+        arrays[name + '.vectors'] = pool.vectors
+        arrays[name + '.matrices'] = pool.matrices
+
+    # write next to the old checkpoint and swap it in, so that a job
+    # killed halfway through saving still has the previous one
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path, shared_memory = False):
+    # returns map_builder, extra
+    with np.load(path) as arrays:
+        arrays = dict(arrays)
+    meta = json.loads(str(arrays['meta']))
+    if meta['version'] != CHECKPOINT_VERSION:
+        raise RuntimeError("Unsupported checkpoint version", meta['version'])
+
+    tag_side_lengths = { tag_id: side_length for tag_id, side_length in meta['tag_side_lengths'] }
+    map_builder = MapBuilder(arrays['camera_matrix'], tag_side_lengths, meta['map_type'],
+                             robust_kernel=meta['robust_kernel'],
+                             message_passing=meta['message_passing'],
+                             solver=meta['solver'],
+                             scheduling=meta['scheduling'],
+                             shared_memory=shared_memory,
+                             gauge=meta.get('gauge', "recenter"))
+    map_builder.lm_linear_solver = meta['lm_linear_solver']
+    map_builder.schedule_threshold = meta['schedule_threshold']
+    map_builder.huber_k = meta['huber_k']
+    map_builder.inverse_pixel_cov = meta['inverse_pixel_cov']
+    map_builder.regularizer = meta['regularizer']
+    map_builder.streak = meta['streak']
+
+    map_builder.viewpoint_ids = list(meta['viewpoint_ids'])
+    map_builder.viewpoint_id_to_idx = { viewpoint_id: idx for idx, viewpoint_id in enumerate(map_builder.viewpoint_ids) }
+    map_builder.tag_ids = list(meta['tag_ids'])
+    map_builder.tag_id_to_idx = { tag_id: idx for idx, tag_id in enumerate(map_builder.tag_ids) }
+    map_builder.viewpoint_detections = [(int(start), int(end)) for start, end in arrays['viewpoint_detections']]
+    map_builder.viewpoint_poses.assign(arrays['txs_world_viewpoint'])
+    map_builder.tag_poses.assign(arrays['txs_world_tag'])
+    map_builder.corners_mats.assign([get_corners_mat(size=map_builder.get_tag_side_length(tag_id))
+                                     for tag_id in map_builder.tag_ids])
+
+    store = map_builder.detection_store
+    num_detections = len(arrays['detections.tag_idxs'])
+    store.reserve(num_detections)
+    store.size = num_detections
+    for field in store.fields:
+        store.arrays[field][:num_detections] = arrays['detections.' + field]
+
+    map_builder.tag_detections = [[] for _ in map_builder.tag_ids]
+    for det_idx, tag_idx in enumerate(store.tag_idxs):
+        map_builder.tag_detections[tag_idx].append(det_idx)
+
+    for name, pool in get_info_pools(map_builder).items():
+        vectors = arrays[name + '.vectors']
+        if len(vectors):
+            pool.set(slice(pool.append(len(vectors)), None), vectors, arrays[name + '.matrices'])
+
+    # the regularizer that is inside each belief, see MapBuilder.set_regularizer
+    map_builder.viewpoint_priors = [float(prior) for prior in arrays['viewpoint_priors']]
+    map_builder.tag_priors = [float(prior) for prior in arrays['tag_priors']]
+    map_builder.priors_pending = any(prior != map_builder.regularizer
+                                     for prior in map_builder.viewpoint_priors + map_builder.tag_priors)
+
+    # only the live entry of each variable matters in the heap
+    map_builder.viewpoint_residuals = [float(residual) for residual in arrays['viewpoint_residuals']]
+    map_builder.tag_residuals = [float(residual) for residual in arrays['tag_residuals']]
+    map_builder.schedule_heap = []
+    for kind, residuals in [("viewpoint", map_builder.viewpoint_residuals), ("tag", map_builder.tag_residuals)]:
+        for idx, residual in enumerate(residuals):
+            if residual > 0:
+                map_builder.schedule_heap.append((-residual, kind, idx))
+    heapq.heapify(map_builder.schedule_heap)
+
+    if shared_memory:
+        map_builder.allocator.set_counts(len(map_builder.viewpoint_ids), len(map_builder.tag_ids), num_detections)
+
+    return map_builder, meta['extra']
+
+if __name__ == "__main__":
+    import tempfile
+    from pytagmapper import data
+
+    scene_data = data.load_data(os.path.join(os.path.dirname(__file__), "..", "example_data"))
+    viewpoint_ids = sorted(scene_data['viewpoints'].keys(), key=int)
+
+    for map_type in ["2d", "2.5d", "3d"]:
+        map_builder = MapBuilder(scene_data['camera_matrix'], scene_data['tag_side_lengths'], map_type)
+        for viewpoint_id in viewpoint_ids[:8]:
+            map_builder.insert_viewpoint(viewpoint_id, scene_data['viewpoints'][viewpoint_id])
+        for i in range(5):
+            map_builder.send_detection_to_viewpoint_msgs()
+            map_builder.send_detection_to_tag_msgs()
+            map_builder.update()
+
+        path = os.path.join(tempfile.mkdtemp(), "checkpoint.npz")
+        save_checkpoint(path, map_builder, { 'note': map_type })
+        loaded_map_builder, extra = load_checkpoint(path)
+        assert extra == { 'note': map_type }
+
+        # both carry on the same way
+        for mb in [map_builder, loaded_map_builder]:
+            mb.insert_viewpoint(viewpoint_ids[8], scene_data['viewpoints'][viewpoint_ids[8]])
+            for i in range(5):
+                mb.send_detection_to_viewpoint_msgs()
+                mb.send_detection_to_tag_msgs()
+                mb.update()
+
+        diff = max(np.max(np.abs(map_builder.tag_poses.array - loaded_map_builder.tag_poses.array)),
+                   np.max(np.abs(map_builder.viewpoint_poses.array - loaded_map_builder.viewpoint_poses.array)))
+        print(map_type, "size", os.path.getsize(path), "max pose difference after resuming", diff)
+        assert diff == 0
@@ -0,0 +1,146 @@
+import time
+
+# decides when an optimization loop is done
+#
+#   convergence = ConvergenceController(max_its = 100)
+#   convergence.start(map_builder.get_avg_detection_error())
+#   while not convergence.done:
+#       improved = ... one optimization step ...
+#       convergence.update(map_builder.get_avg_detection_error(), improved)
+#   print(convergence.num_its, convergence.reason)
+#
+# the loop is done once any of these holds
+#  "converged"   at least min_its iterations, the error is under
+#                target_error, and the last step did not improve it by
+#                more than rtol (relative)
+#  "atol"        the error is at most atol
+#  "min_rtol"    an improving step changed the error by less than
+#                min_rtol (relative), whatever the error is
+#  "stalled"     the best error of the last stall_its iterations is not
+#                stall_rtol (relative) better than the best error before
+#  "max_its"     max_its iterations
+#  "max_seconds" max_seconds of wall time since start
+#
+# any of the budgets can be None to turn it off. everything except
+# max_seconds only depends on the errors, so a loop without a time
+# budget always stops at the same iteration
+#
+# get_state / set_state carry a loop over into another process, eg
+# when a build is resumed from a checkpoint, with the errors, iteration
+# count and elapsed time it had so far, so the budgets do not restart
+#
+# anything with the same start / update / done / num_its / reason
+# can stand in for this class
+class ConvergenceController:
+    def __init__(self, target_error = 0.5, rtol = 1e-3, atol = 0.0, min_its = 3,
+                 min_rtol = None, stall_its = None, stall_rtol = 1e-3,
+                 max_its = None, max_seconds = None):
+        self.target_error = target_error
+        self.rtol = rtol
+        self.atol = atol
+        self.min_its = min_its
+        self.min_rtol = min_rtol
+        self.stall_its = stall_its
+        self.stall_rtol = stall_rtol
+        self.max_its = max_its
+        self.max_seconds = max_seconds
+        self.start(float('inf'))
+
+    def start(self, error):
+        self.errors = [error]
+        self.num_its = 0
+        self.change = 1.0
+        self.reason = None
+        self.start_time = time.time()
+
+    @property
+    def done(self):
+        return self.reason is not None
+
+    @property
+    def error(self):
+        return self.errors[-1]
+
+    def stop(self, reason):
+        # end the loop from outside, eg on ctrl+c
+        self.reason = reason
+
+    def get_elapsed(self):
+        return time.time() - self.start_time
+
+    def get_state(self):
+        # json serializable
+        return {
+            'errors': list(self.errors),
+            'num_its': self.num_its,
+            'change': self.change,
+            'elapsed': self.get_elapsed(),
+        }
+
+    def set_state(self, state):
+        # continue a loop saved with get_state
+        self.errors = list(state['errors'])
+        self.num_its = state['num_its']
+        self.change = state['change']
+        self.reason = None
+        self.start_time = time.time() - state['elapsed']
+
+    def is_stalled(self):
+        if self.stall_its is None or len(self.errors) <= self.stall_its:
+            return False
+        best_before = min(self.errors[:-self.stall_its])
+        best_recent = min(self.errors[-self.stall_its:])
+        return best_recent > (1 - self.stall_rtol) * best_before
+
+    def update(self, error, improved):
+        # returns True once the loop is done
+        prev_error = self.errors[-1]
+        self.errors.append(error)
+        self.num_its += 1
+        delta = max(prev_error - error, 0)
+        self.change = delta/prev_error if prev_error > 0 else 0.0
+
+        if error <= self.atol:
+            self.reason = "atol"
+        elif self.num_its >= self.min_its and error < self.target_error and \
+             (not improved or self.change < self.rtol):
+            self.reason = "converged"
+        elif self.min_rtol is not None and improved and self.change <= self.min_rtol:
+            self.reason = "min_rtol"
+        elif self.is_stalled():
+            self.reason = "stalled"
+        elif self.max_its is not None and self.num_its >= self.max_its:
+            self.reason = "max_its"
+        elif self.max_seconds is not None and self.get_elapsed() >= self.max_seconds:
+            self.reason = "max_seconds"
+        return self.done
+
+if __name__ == "__main__":
+    # a plateau that never gets under the target error
+    convergence = ConvergenceController(stall_its = 10, max_its = 1000)
+    convergence.start(10.0)
+    error = 10.0
+    while not convergence.done:
+        error = max(error * 0.5, 2.5)
+        convergence.update(error, True)
+    print("plateau", convergence.num_its, convergence.reason)
+    assert convergence.reason == "stalled"
+
+    convergence = ConvergenceController(max_its = 5)
+    convergence.start(10.0)
+    while not convergence.done:
+        convergence.update(10.0, False)
+    print("budget", convergence.num_its, convergence.reason)
+    assert convergence.reason == "max_its" and convergence.num_its == 5
+
+    # a loop that is stopped halfway and continued from its state
+    convergence = ConvergenceController(max_its = 5)
+    convergence.start(10.0)
+    for i in range(3):
+        convergence.update(10.0, False)
+    resumed = ConvergenceController(max_its = 5)
+    resumed.set_state(convergence.get_state())
+    while not resumed.done:
+        resumed.update(10.0, False)
+    print("resumed budget", resumed.num_its, resumed.reason)
+    assert resumed.reason == "max_its" and resumed.num_its == 5
@@ -0,0 +1,245 @@
+import heapq
+import numpy as np
+from pytagmapper.sparse_solver import get_schur_complement, get_group_pairs
+
+# marginal covariances of every tag and viewpoint pose of a map
+#
+# the information matrix of the detections at the current
+# linearization point
+#
+#  ⎡ H_vv   H_vt ⎤
+#  ⎣ H_tv   H_tt ⎦
+#
+# is the same system solve_lm builds, without the damping. the map is
+# only defined up to where tag0 is (recenter puts tag0 at the origin),
+# so tag0 is held fixed and every covariance is relative to it
+#
+# the viewpoints are eliminated with the schur complement, leaving the
+# sparse reduced system S on the tags. only some blocks of S⁻¹ are needed
+#   tag covariances        the diagonal blocks of S⁻¹
+#   viewpoint covariances  H_vv⁻¹ + W S⁻¹ Wᵀ, which only needs the
+#                          blocks of S⁻¹ between tags seen by the same
+#                          viewpoint, W = H_vv⁻¹ H_vt
+# and all of them are nonzero blocks of S. S is factored as L D Lᵀ over
+# its blocks in a minimum degree order, and the takahashi recursion
+# (see get_selected_inverse) gives S⁻¹ on the nonzero blocks of L only.
+# the work and memory grow with the fill of L rather than with the
+# number of tags squared. the fill depends on which tags are seen
+# together, a map where every tag is seen with every other one fills L
+# completely and costs as much as inverting S
+#
+# covariances are in the same tangent coordinates as the updates,
+# tx_world_pose @ exp(delta)
+#   viewpoints  wx wy wz x y z
+#   tags        wz x y (2d), wz x y z (2.5d), wx wy wz x y z (3d)
+# in units of the pixel noise set by inverse_pixel_cov
+#
+#   viewpoint_covs, tag_covs = get_marginal_covariances(map_builder)
+
+def get_min_degree_order(neighbors):
+    # elimination order of a graph, each step eliminates the node with
+    # the fewest neighbors left and connects those neighbors to each
+    # other. returns the order and, for each eliminated node, its
+    # neighbors at that point. they all come later in the order and are
+    # the nonzero blocks below the diagonal in its column of L
+    neighbors = [set(node_neighbors) for node_neighbors in neighbors]
+    heap = [(len(node_neighbors), node) for node, node_neighbors in enumerate(neighbors)]
+    heapq.heapify(heap)
+    eliminated = np.zeros(len(neighbors), dtype=bool)
+    order = []
+    structure = []
+    while heap:
+        degree, node = heapq.heappop(heap)
+        if eliminated[node] or degree != len(neighbors[node]):
+            continue # stale entry
+        eliminated[node] = True
+        order.append(node)
+        structure.append(neighbors[node])
+        for neighbor in neighbors[node]:
+            neighbor_neighbors = neighbors[neighbor]
+            neighbor_neighbors |= neighbors[node]
+            neighbor_neighbors.discard(neighbor)
+            neighbor_neighbors.discard(node)
+            heapq.heappush(heap, (len(neighbor_neighbors), neighbor))
+    return order, structure
+
+def get_selected_inverse(S, block_size, block_rows, block_cols):
+    # blocks (block_rows[i], block_cols[i]) of S⁻¹, for a symmetric
+    # positive definite S and only for blocks that are nonzero in S
+    d = block_size
+    S = S.tobsr(blocksize=(d, d))
+    num_blocks = S.shape[0] // d
+    S_rows = np.repeat(np.arange(num_blocks), np.diff(S.indptr))
+    S_cols = S.indices
+
+    off_diagonal = S_rows != S_cols
+    neighbors = [[] for _ in range(num_blocks)]
+    for row, col in zip(S_rows[off_diagonal].tolist(), S_cols[off_diagonal].tolist()):
+        neighbors[row].append(col)
+    order, structure = get_min_degree_order(neighbors)
+    position = np.empty(num_blocks, dtype=np.int64)
+    position[order] = np.arange(num_blocks)
+
+    # everything below is by position in the elimination order
+    # column p of L has nonzero blocks at rows[p], all after p. the
+    # blocks below the diagonal of every column are kept in one array,
+    # column after column, and found by their key column * num_blocks + row
+    rows = [np.sort(position[list(node_neighbors)]) for node_neighbors in structure]
+    offsets = np.cumsum([0] + [len(column_rows) for column_rows in rows])
+    keys = np.concatenate([p * num_blocks + column_rows for p, column_rows in enumerate(rows)] + [np.zeros(0, dtype=np.int64)])
+
+    def get_column_pairs(p):
+        # (a, b) with a > b over the rows of column p, and where block
+        # (rows[p][a], rows[p][b]) is kept
+        a, b = np.tril_indices(len(rows[p]), -1)
+        return a, b, np.searchsorted(keys, rows[p][b] * num_blocks + rows[p][a])
+
+    # the lower half of S, with the fill added in as columns are eliminated
+    S_rows = position[S_rows]
+    S_cols = position[S_cols]
+    diagonal = np.empty((num_blocks, d, d))
+    on_diagonal = S_rows == S_cols
+    diagonal[S_cols[on_diagonal]] = S.data[on_diagonal]
+    lower = np.zeros((len(keys), d, d))
+    below = S_rows > S_cols
+    lower[np.searchsorted(keys, S_cols[below] * num_blocks + S_rows[below])] = S.data[below]
+
+    # block L D Lᵀ, column by column
+    #   D_p = S_pp,  L_qp = S_qp D_p⁻¹
+    #   S_qr -= L_qp D_p L_rpᵀ = L_qp S_rpᵀ    for q ≥ r below p
+    # the rows of column p are all in each other's columns
+    D_inv = np.empty_like(diagonal)
+    L = np.empty_like(lower)
+    for p in range(num_blocks):
+        n = len(rows[p])
+        column = lower[offsets[p]:offsets[p+1]]
+        D_inv[p] = np.linalg.inv(diagonal[p])
+        L[offsets[p]:offsets[p+1]] = column @ D_inv[p]
+        updates = (L[offsets[p]:offsets[p+1]].reshape((n*d, d)) @ column.reshape((n*d, d)).T).reshape((n, d, n, d))
+        diagonal[rows[p]] -= updates[np.arange(n), :, np.arange(n), :]
+        a, b, pair_keys = get_column_pairs(p)
+        lower[pair_keys] -= updates[a, :, b, :]
+
+    # takahashi recursion, from the last column back
+    # Z = S⁻¹ solves Z L = L⁻ᵀ D⁻¹, whose part below the diagonal is 0 and
+    # whose diagonal is D⁻¹, so for q below p in the structure of column p
+    #   Z_qp = -Σ_r Z_qr L_rp
+    #   Z_pp = D_p⁻¹ - Σ_r Z_rpᵀ L_rp
+    # every Z_qr there is between two rows of column p, and those are
+    # filled in by the time column p is reached. only the blocks below
+    # the diagonal of Z_qr are gathered, the ones above are their
+    # transposes and come in through a transposed product
+    Z_diagonal = np.empty_like(diagonal)
+    Z_lower = np.empty_like(lower)
+    for p in reversed(range(num_blocks)):
+        n = len(rows[p])
+        Z_rows = np.zeros((n, d, n, d))
+        a, b, pair_keys = get_column_pairs(p)
+        Z_rows[a, :, b, :] = Z_lower[pair_keys]
+        Z_rows = Z_rows.reshape((n*d, n*d))
+        L_column = L[offsets[p]:offsets[p+1]]
+        Z_column = (Z_diagonal[rows[p]] @ L_column).reshape((n*d, d))
+        L_column = L_column.reshape((n*d, d))
+        Z_column += Z_rows @ L_column + (L_column.T @ Z_rows).T
+        Z_column = -Z_column
+        Z_lower[offsets[p]:offsets[p+1]] = Z_column.reshape((n, d, d))
+        Z_diagonal[p] = D_inv[p] - Z_column.T @ L_column
+
+    # the requested blocks, transposing the ones above the diagonal
+    block_rows = position[block_rows]
+    block_cols = position[block_cols]
+    result = Z_diagonal[block_rows]
+    below = block_rows > block_cols
+    result[below] = Z_lower[np.searchsorted(keys, block_cols[below] * num_blocks + block_rows[below])]
+    above = block_rows < block_cols
+    result[above] = Z_lower[np.searchsorted(keys, block_rows[above] * num_blocks + block_cols[above])].transpose(0,2,1)
+    return result
+
+def get_marginal_covariances(map_builder):
+    # returns viewpoint covariances (V, 6, 6) and tag covariances (T, tag_dof, tag_dof)
+    store = map_builder.detection_store
+    dof = map_builder.tag_dof
+    num_viewpoints = len(map_builder.viewpoint_ids)
+    num_tags = len(map_builder.tag_ids)
+    viewpoint_idxs = store.viewpoint_idxs
+    JtJs = store.JtJs
+
+    H_vv = np.zeros((num_viewpoints, 6, 6))
+    np.add.at(H_vv, viewpoint_idxs, JtJs[:,:6,:6])
+
+    viewpoint_covs = np.linalg.inv(H_vv)
+    tag_covs = np.zeros((num_tags, dof, dof))
+    num_free_tags = num_tags - 1
+    if num_free_tags <= 0:
+        return viewpoint_covs, tag_covs
+
+    # tag0 is fixed, so its detections only add to H_vv
+    free = store.tag_idxs != 0
+    free_viewpoint_idxs = viewpoint_idxs[free]
+    free_tag_idxs = store.tag_idxs[free] - 1
+    H_vt = JtJs[free,:6,6:]
+    H_tt = np.zeros((num_free_tags, dof, dof))
+    np.add.at(H_tt, free_tag_idxs, JtJs[free,6:,6:])
+
+    S, _, _, H_vv_inv = get_schur_complement(
+        H_vv, H_tt, H_vt, free_viewpoint_idxs, free_tag_idxs,
+        np.zeros((num_viewpoints, 6, 1)), np.zeros((num_free_tags, dof, 1)))
+
+    # (i, j) detection pairs of the same viewpoint
+    pair_i, pair_j = get_group_pairs(free_viewpoint_idxs)
+    blocks = get_selected_inverse(S, dof,
+                                  np.concatenate((np.arange(num_free_tags), free_tag_idxs[pair_i])),
+                                  np.concatenate((np.arange(num_free_tags), free_tag_idxs[pair_j])))
+    tag_covs[1:] = blocks[:num_free_tags]
+    pair_covs = blocks[num_free_tags:]
+
+    W = H_vv_inv[free_viewpoint_idxs] @ H_vt # N x 6 x dof
+    np.add.at(viewpoint_covs, free_viewpoint_idxs[pair_i],
+              W[pair_i] @ pair_covs @ W[pair_j].transpose(0,2,1))
+
+    return viewpoint_covs, tag_covs
+
+if __name__ == "__main__":
+    import os
+    from pytagmapper import data
+    from pytagmapper.map_builder import MapBuilder
+
+    scene_data = data.load_data(os.path.join(os.path.dirname(__file__), "..", "example_data"))
+    viewpoint_ids = sorted(scene_data['viewpoints'].keys(), key=int)
+
+    # against inverting the full information matrix
+    for map_type in ["2d", "2.5d", "3d"]:
+        map_builder = MapBuilder(scene_data['camera_matrix'], scene_data['tag_side_lengths'], map_type, solver="lm")
+        for viewpoint_id in viewpoint_ids:
+            map_builder.insert_viewpoint(viewpoint_id, scene_data['viewpoints'][viewpoint_id])
+        map_builder.relinearize()
+        for i in range(20):
+            map_builder.update()
+
+        viewpoint_covs, tag_covs = get_marginal_covariances(map_builder)
+
+        store = map_builder.detection_store
+        dof = map_builder.tag_dof
+        num_viewpoints = len(map_builder.viewpoint_ids)
+        num_tags = len(map_builder.tag_ids)
+        H = np.zeros((num_viewpoints*6 + num_tags*dof,)*2)
+        for det_idx in range(len(store)):
+            v = store.viewpoint_idxs[det_idx]*6
+            t = num_viewpoints*6 + store.tag_idxs[det_idx]*dof
+            idxs = np.concatenate((np.arange(v, v+6), np.arange(t, t+dof)))
+            H[np.ix_(idxs, idxs)] += store.JtJs[det_idx]
+        free = np.ones(len(H), dtype=bool)
+        free[num_viewpoints*6:num_viewpoints*6 + dof] = False # tag0
+        cov = np.zeros(H.shape)
+        cov[np.ix_(free, free)] = np.linalg.inv(H[np.ix_(free, free)])
+
+        diff = 0
+        for viewpoint_idx in range(num_viewpoints):
+            block = cov[viewpoint_idx*6:(viewpoint_idx+1)*6, viewpoint_idx*6:(viewpoint_idx+1)*6]
+            diff = max(diff, np.max(np.abs(block - viewpoint_covs[viewpoint_idx]))/np.max(np.abs(block)))
+        for tag_idx in range(1, num_tags):
+            t = num_viewpoints*6 + tag_idx*dof
+            block = cov[t:t+dof, t:t+dof]
+            diff = max(diff, np.max(np.abs(block - tag_covs[tag_idx]))/np.max(np.abs(block)))
+        print(map_type, "max relative difference to the dense inverse", diff)
+        assert diff < 1e-6
@@ -0,0 +1,119 @@
+import heapq
+from collections import defaultdict
+
+# which viewpoint to add to a map next
+#
+# keeps, for every viewpoint not yet in the map, how many of its tags
+# are already in the map, and a max heap on that count
+#
+#   tag => viewpoints that see it
+#   viewpoint => overlap with the map
+#
+# adding a viewpoint to the map only touches the viewpoints that see
+# one of its new tags, so picking every viewpoint of a build costs
+# about the total number of detections instead of O(V^2 T)
+#
+#   index = CovisibilityIndex(viewpoints)
+#   viewpoint_id = index.pop_best(min_overlap = 0) # first viewpoint
+#   while viewpoint_id is not None:
+#       ... add viewpoint_id to the map ...
+#       index.add_viewpoint(viewpoint_id)
+#       viewpoint_id = index.pop_best()
+#
+# ties go to the viewpoint that came first in viewpoints
+class CovisibilityIndex:
+    def __init__(self, viewpoints):
+        # viewpoints is viewpoint_id => {tag_id => corners}
+        self.viewpoints = viewpoints
+        self.order = {}
+        self.tag_viewpoints = defaultdict(list)
+        for viewpoint_id, tags in viewpoints.items():
+            self.order[viewpoint_id] = len(self.order)
+            for tag_id in tags:
+                self.tag_viewpoints[tag_id].append(viewpoint_id)
+
+        self.remaining = set(viewpoints.keys())
+        self.clear_map()
+
+    def clear_map(self):
+        # start over from an empty map, keeping the viewpoints already taken
+        self.map_tags = set()
+        self.overlaps = { viewpoint_id: 0 for viewpoint_id in self.remaining }
+        self.heap = [] # (-overlap, order, viewpoint_id)
+        for viewpoint_id in self.remaining:
+            self.heap.append((0, self.order[viewpoint_id], viewpoint_id))
+        heapq.heapify(self.heap)
+
+    def get_overlap(self, viewpoint_id):
+        return self.overlaps[viewpoint_id]
+
+    def add_tags(self, tag_ids):
+        # tags that are now in the map
+        for tag_id in tag_ids:
+            if tag_id in self.map_tags:
+                continue
+            self.map_tags.add(tag_id)
+            for viewpoint_id in self.tag_viewpoints[tag_id]:
+                if viewpoint_id not in self.remaining:
+                    continue
+                self.overlaps[viewpoint_id] += 1
+                # the older entry for this viewpoint goes stale
+                heapq.heappush(self.heap, (-self.overlaps[viewpoint_id], self.order[viewpoint_id], viewpoint_id))
+
+    def add_viewpoint(self, viewpoint_id):
+        # viewpoint_id is now in the map
+        self.remaining.discard(viewpoint_id)
+        self.overlaps.pop(viewpoint_id, None)
+        self.add_tags(self.viewpoints[viewpoint_id].keys())
+
+    def pop_best(self, min_overlap = 1):
+        # takes the viewpoint with the most tags in the map, or None if
+        # no viewpoint has min_overlap of them
+        # min_overlap = 0 falls back to viewpoints with no overlap at all
+        while self.heap:
+            neg_overlap, _, viewpoint_id = self.heap[0]
+            if viewpoint_id not in self.remaining or -neg_overlap != self.overlaps[viewpoint_id]:
+                heapq.heappop(self.heap) # stale entry
+                continue
+            if -neg_overlap < min_overlap:
+                return None
+            heapq.heappop(self.heap)
+            self.remaining.remove(viewpoint_id)
+            del self.overlaps[viewpoint_id]
+            return viewpoint_id
+        return None
+
+    def __len__(self):
+        # viewpoints not yet taken
+        return len(self.remaining)
+
+if __name__ == "__main__":
+    import random
+
+    # against the brute force scan that build_map used to do
+    rng = random.Random(0)
+    viewpoints = {}
+    for viewpoint_id in range(200):
+        viewpoints[viewpoint_id] = { tag_id: None for tag_id in rng.sample(range(60), rng.randint(1, 6)) }
+
+    index = CovisibilityIndex(viewpoints)
+    map_tags = set()
+    used = set()
+    while len(index):
+        viewpoint_id = index.pop_best(min_overlap = 0)
+
+        best_viewpoint_id = None
+        best_overlap = -1
+        for other_viewpoint_id in viewpoints:
+            if other_viewpoint_id in used:
+                continue
+            overlap = len(viewpoints[other_viewpoint_id].keys() & map_tags)
+            if overlap > best_overlap:
+                best_overlap = overlap
+                best_viewpoint_id = other_viewpoint_id
+        assert viewpoint_id == best_viewpoint_id, (viewpoint_id, best_viewpoint_id)
+
+        index.add_viewpoint(viewpoint_id)
+        map_tags |= viewpoints[viewpoint_id].keys()
+        used.add(viewpoint_id)
+    print("matched the brute force order for", len(used), "viewpoints")
@@ -146,6 +146,39 @@ def load_map(data_dir):
         data['tag_side_lengths'] = tag_side_lengths_fixed
         return data
 
+def save_covariances_json(data_dir, map_type, tag_ids, tag_covs, viewpoint_ids, viewpoint_covs):
+    # see covariance.py for the coordinates of each covariance
+    data = {
+        'map_type': map_type,
+        'tag_covariances': {},
+        'viewpoint_covariances': {},
+    }
+    for tag_id, tag_cov in zip(tag_ids, tag_covs):
+        data['tag_covariances'][tag_id] = tag_cov.tolist()
+    for viewpoint_id, viewpoint_cov in zip(viewpoint_ids, viewpoint_covs):
+        data['viewpoint_covariances'][viewpoint_id] = viewpoint_cov.tolist()
+
+    with open(get_path(data_dir, "covariances.json"), "w") as f:
+        json.dump(data, f)
+
+def load_covariances(data_dir):
+    with open(get_path(data_dir, "covariances.json")) as f:
+        data = json.load(f)
+
+        # convert string tag keys to int keys
+        # convert to numpy
+        tag_covariances_fixed = {}
+        for k, v in data['tag_covariances'].items():
+            tag_covariances_fixed[int(k)] = np.array(v)
+
+        viewpoint_covariances_fixed = {}
+        for k, v in data['viewpoint_covariances'].items():
+            viewpoint_covariances_fixed[k] = np.array(v)
+
+        data['tag_covariances'] = tag_covariances_fixed
+        data['viewpoint_covariances'] = viewpoint_covariances_fixed
+        return data
+
 def load_viewpoints(data_dir):
     with open(get_path(data_dir, "viewpoints.json")) as f:
         data = json.load(f)
@@ -0,0 +1,88 @@
+import numpy as np
+from pytagmapper.shared_state import HeapAllocator
+
+# contiguous, growable storage for the detection factors of a MapBuilder
+# every field is an array whose first axis is the detection index
+#
+# capacity doubles whenever it runs out so that appending is amortized O(1)
+# the public attributes are views of the first `size` rows, so they must be
+# re-fetched after an append (the backing arrays may have been reallocated)
+class DetectionStore:
+    def __init__(self, tag_dof, capacity = 64, allocator = None, name = "detections"):
+        self.tag_dof = tag_dof
+        self.allocator = allocator or HeapAllocator()
+        self.name = name
+        dim_detection_factor_input = 6 + tag_dof
+
+        # name => (shape of one row, dtype, initial value)
+        self.fields = {
+            'tag_idxs': ((), np.int64, 0),
+            'viewpoint_idxs': ((), np.int64, 0),
+            'corners': ((8,1), np.float64, 0),
+            'projections': ((8,1), np.float64, 0),
+            'residuals': ((8,1), np.float64, 0),
+            'jacobians': ((8,dim_detection_factor_input), np.float64, 0),
+            'JtJs': ((dim_detection_factor_input,dim_detection_factor_input), np.float64, 0),
+            'rtJs': ((1,dim_detection_factor_input), np.float64, 0),
+            'errors': ((), np.float64, float('inf')),
+        }
+
+        self.size = 0
+        self.capacity = 0
+        self.arrays = {}
+        self.reserve(capacity)
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+
+        for name, (row_shape, dtype, fill) in self.fields.items():
+            array = self.allocator.allocate(self.name + "." + name, (capacity,) + row_shape, dtype, fill)
+            if name in self.arrays:
+                array[:self.size] = self.arrays[name][:self.size]
+            self.arrays[name] = array
+        self.capacity = capacity
+
+    def append(self, tag_idx, viewpoint_idx, corners):
+        if self.size == self.capacity:
+            self.reserve(max(2*self.capacity, 1))
+
+        det_idx = self.size
+        self.arrays['tag_idxs'][det_idx] = tag_idx
+        self.arrays['viewpoint_idxs'][det_idx] = viewpoint_idx
+        self.arrays['corners'][det_idx] = np.reshape(corners, (8,1))
+        self.size += 1
+        return det_idx
+
+    def __len__(self):
+        return self.size
+
+    def __getattr__(self, name):
+        # views into the live rows of each field
+        fields = self.__dict__.get('fields', {})
+        if name in fields:
+            return self.__dict__['arrays'][name][:self.__dict__['size']]
+        raise AttributeError(name)
+
+class DetectionsView:
+    # list-style access to a DetectionStore
+    # each item is a (tag_idx, viewpoint_idx, tag_corners) tuple
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, det_idx):
+        if det_idx < 0:
+            det_idx += len(self.store)
+        if det_idx < 0 or det_idx >= len(self.store):
+            raise IndexError("detection index out of range", det_idx)
+        arrays = self.store.arrays
+        return (int(arrays['tag_idxs'][det_idx]),
+                int(arrays['viewpoint_idxs'][det_idx]),
+                arrays['corners'][det_idx])
+
+    def __iter__(self):
+        for det_idx in range(len(self.store)):
+            yield self[det_idx]
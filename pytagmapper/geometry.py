@@ -35,6 +35,15 @@ def SE2_to_SE3(SE2):
     SE3[:2,3] = SE2[:2,2]
     return SE3
 
+def SE2_to_SE3_batch(SE2s):
+    # SE2s is (N, 3, 3), result is (N, 4, 4)
+    SE3s = np.zeros((SE2s.shape[0],4,4))
+    SE3s[:,:2,:2] = SE2s[:,:2,:2]
+    SE3s[:,:2,3] = SE2s[:,:2,2]
+    SE3s[:,2,2] = 1
+    SE3s[:,3,3] = 1
+    return SE3s
+
 def SE3_to_SE2(SE3):
     """try to coerce an SE3 into an SE2
     by assuming it's mostly flat in xy plane
@@ -95,6 +104,20 @@ def so3_to_matrix(so3):
     ])
     return so3_matrix
 
+def so3_to_matrix_batch(so3s):
+    # so3s is (N, 3), result is (N, 3, 3)
+    wx = so3s[:,0]
+    wy = so3s[:,1]
+    wz = so3s[:,2]
+    so3_matrices = np.zeros((so3s.shape[0],3,3))
+    so3_matrices[:,0,1] = -wz
+    so3_matrices[:,0,2] =  wy
+    so3_matrices[:,1,0] =  wz
+    so3_matrices[:,1,2] = -wx
+    so3_matrices[:,2,0] = -wy
+    so3_matrices[:,2,1] =  wx
+    return so3_matrices
+
 def se3_to_matrix(se3):
     result = np.empty((4,4))
     result[:3,:3] = so3_to_matrix(se3[:3,:])
@@ -129,6 +152,35 @@ def se3_exp(se3):
     result[:3,3:4] = ((omega*B + omega_squared*C) @ v) + v
     return result
 
+def se3_exp_batch(se3s):
+    # se3s is (N, 6) or (N, 6, 1), result is (N, 4, 4)
+    se3s = se3s.reshape((-1,6))
+    N = se3s.shape[0]
+    omega_vecs = se3s[:,:3]
+    theta_squared = np.sum(omega_vecs**2, axis=1)
+    omega = so3_to_matrix_batch(omega_vecs)
+
+    # second order taylor expansion where the angle is small
+    small = theta_squared < 1e-8
+    theta = np.sqrt(np.where(small, 1.0, theta_squared))
+    stheta = np.sin(theta)
+    ctheta = np.cos(theta)
+    A = np.where(small, -theta_squared/6.0 + 1.0, stheta / theta)
+    B = np.where(small, -theta_squared/24.0 + 0.5, (-ctheta + 1.0) / theta**2)
+    C = np.where(small, -theta_squared/120.0 + (1.0/6.0), (-A + 1.0) / theta**2)
+    A = A[:,None,None]
+    B = B[:,None,None]
+    C = C[:,None,None]
+
+    omega_squared = omega @ omega
+    v = se3s[:,3:,None]
+
+    result = np.zeros((N,4,4))
+    result[:,:3,:3] = np.eye(3) + omega*A + omega_squared*B
+    result[:,:3,3:4] = ((omega*B + omega_squared*C) @ v) + v
+    result[:,3,3] = 1
+    return result
+
 def se2_exp(se2):
     theta = se2[0,0]
     x = se2[1,0]
@@ -155,6 +207,31 @@ def se2_exp(se2):
 
     return out
 
+def se2_exp_batch(se2s):
+    # se2s is (N, 3) or (N, 3, 1), result is (N, 3, 3)
+    se2s = se2s.reshape((-1,3))
+    N = se2s.shape[0]
+    theta = se2s[:,0]
+    x = se2s[:,1]
+    y = se2s[:,2]
+
+    small = np.abs(theta) < 1e-6
+    r_p = (x + 1j*y)/np.where(small, 1.0, theta)
+    r = r_p * 1j
+    rotation = np.cos(theta) + 1j*np.sin(theta)
+    ep = np.where(small, x + 1j*y, r + (-r * rotation))
+    ed = np.where(small, 1.0, rotation)
+
+    result = np.zeros((N,3,3))
+    result[:,0,0] = ed.real
+    result[:,0,1] = -ed.imag
+    result[:,1,0] = ed.imag
+    result[:,1,1] = ed.real
+    result[:,0,2] = ep.real
+    result[:,1,2] = ep.imag
+    result[:,2,2] = 1
+    return result
+
 def xyt_right_apply_se2(xyt, se2):
     SE2 = xyt_to_SE2(xyt)
     SE2 = SE2 @ se2_exp(se2)
@@ -173,6 +250,16 @@ def SE3_adj(SE3):
     result[:3,3:].fill(0)
     return result
 
+def SE3_adj_batch(SE3s):
+    # SE3s is (N, 4, 4), result is (N, 6, 6)
+    R = SE3s[:,:3,:3]
+    pm = so3_to_matrix_batch(SE3s[:,:3,3])
+    result = np.zeros((SE3s.shape[0],6,6))
+    result[:,:3,:3] = R
+    result[:,3:,3:] = R
+    result[:,3:,:3] = pm @ R
+    return result
+
 def SE3_inv(SE3):
     result = np.empty((4,4))
     result[:3,:3] = SE3[:3,:3].T
@@ -180,6 +267,15 @@ def SE3_inv(SE3):
     result[3,:] = [0, 0, 0, 1]
     return result
 
+def SE3_inv_batch(SE3s):
+    # SE3s is (N, 4, 4), result is (N, 4, 4)
+    Rt = SE3s[:,:3,:3].transpose(0,2,1)
+    result = np.zeros(SE3s.shape)
+    result[:,:3,:3] = Rt
+    result[:,:3,3:4] = -Rt @ SE3s[:,:3,3:4]
+    result[:,3,3] = 1
+    return result
+
 def fix_SE3(SE3):
     Rx = SE3[:3, 0]
     Ry = SE3[:3, 1]
@@ -198,6 +294,20 @@ def fix_SE3(SE3):
 
     SE3[3, :] = [0,0,0,1]
 
+def fix_SE3_batch(SE3s):
+    # in place, SE3s is (N, 4, 4)
+    Rx = SE3s[:,:3,0]
+    Ry = SE3s[:,:3,1]
+
+    Rz = np.cross(Rx, Ry)
+    Ry = np.cross(Rz, Rx)
+
+    SE3s[:,:3,0] = Rx / np.linalg.norm(Rx, axis=1, keepdims=True)
+    SE3s[:,:3,1] = Ry / np.linalg.norm(Ry, axis=1, keepdims=True)
+    SE3s[:,:3,2] = Rz / np.linalg.norm(Rz, axis=1, keepdims=True)
+
+    SE3s[:,3,:] = [0,0,0,1]
+
 def SE2_inv(SE2):
     result = np.empty((3,3))
     result[:2,:2] = SE2[:2,:2].T
@@ -205,6 +315,15 @@ def SE2_inv(SE2):
     result[2,:] = [0, 0, 1]
     return result
 
+def SE2_inv_batch(SE2s):
+    # SE2s is (N, 3, 3), result is (N, 3, 3)
+    Rt = SE2s[:,:2,:2].transpose(0,2,1)
+    result = np.zeros(SE2s.shape)
+    result[:,:2,:2] = Rt
+    result[:,:2,2:3] = -Rt @ SE2s[:,:2,2:3]
+    result[:,2,2] = 1
+    return result
+
 def fix_SE2(SE2):
     SE2[0,1] = -SE2[1,0]
     SE2[1,1] = SE2[0,0]
@@ -212,6 +331,13 @@ def fix_SE2(SE2):
     normRxy = np.linalg.norm(Rxy)
     SE2[:2,:2] /= normRxy
 
+def fix_SE2_batch(SE2s):
+    # in place, SE2s is (N, 3, 3)
+    SE2s[:,0,1] = -SE2s[:,1,0]
+    SE2s[:,1,1] = SE2s[:,0,0]
+    normRxy = np.linalg.norm(SE2s[:,:2,0], axis=1)
+    SE2s[:,:2,:2] /= normRxy[:,None,None]
+
 def check_SE2(SE2):
     R = SE2[:2,:2]
     
@@ -305,3 +431,36 @@ if __name__ == "__main__":
 
     fix_SE3(SE3)
     print("Fixed SE3\n", SE3)
+
+    # check batched kernels against the single versions
+    se3s = rng.normal(size=(8,6))
+    se3s[0,:3] = 1e-6 # small angle branch
+    SE3s = se3_exp_batch(se3s)
+    print("se3 exp batch check",
+          max(np.max(np.abs(SE3s[i] - se3_exp(se3s[i:i+1].T))) for i in range(8)))
+    print("SE3 inv batch check",
+          max(np.max(np.abs(SE3_inv_batch(SE3s)[i] - SE3_inv(SE3s[i]))) for i in range(8)))
+    print("SE3 adj batch check",
+          max(np.max(np.abs(SE3_adj_batch(SE3s)[i] - SE3_adj(SE3s[i]))) for i in range(8)))
+
+    se2s = rng.normal(size=(8,3))
+    se2s[0,0] = 1e-7 # small angle branch
+    SE2s = se2_exp_batch(se2s)
+    print("se2 exp batch check",
+          max(np.max(np.abs(SE2s[i] - se2_exp(se2s[i:i+1].T))) for i in range(8)))
+    print("SE2 inv batch check",
+          max(np.max(np.abs(SE2_inv_batch(SE2s)[i] - SE2_inv(SE2s[i]))) for i in range(8)))
+
+    SE3s_bad = SE3s + rng.normal(size=SE3s.shape) * 1e-3
+    SE3s_fixed = SE3s_bad.copy()
+    fix_SE3_batch(SE3s_fixed)
+    for i in range(8):
+        fix_SE3(SE3s_bad[i])
+    print("fix SE3 batch check", np.max(np.abs(SE3s_fixed - SE3s_bad)))
+
+    SE2s_bad = SE2s + rng.normal(size=SE2s.shape) * 1e-3
+    SE2s_fixed = SE2s_bad.copy()
+    fix_SE2_batch(SE2s_fixed)
+    for i in range(8):
+        fix_SE2(SE2s_bad[i])
+    print("fix SE2 batch check", np.max(np.abs(SE2s_fixed - SE2s_bad)))
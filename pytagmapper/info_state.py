@@ -1,9 +1,10 @@
 import numpy as np
+from pytagmapper.shared_state import HeapAllocator
 
 class InfoState4:
-    def __init__(self, vector=np.zeros(shape=(4,1)), matrix=np.zeros(shape=(4,4))):
-        self.vector = vector
-        self.matrix = matrix
+    def __init__(self, vector=None, matrix=None):
+        self.vector = np.zeros(shape=(4,1)) if vector is None else vector
+        self.matrix = np.zeros(shape=(4,4)) if matrix is None else matrix
 
     def __add__(self, other):
         return InfoState4(self.vector + other.vector, self.matrix + other.matrix)
@@ -16,9 +17,9 @@ class InfoState4:
         self.matrix.fill(0)
 
 class InfoState3:
-    def __init__(self, vector=np.zeros(shape=(3,1)), matrix=np.zeros(shape=(3,3))):
-        self.vector = vector
-        self.matrix = matrix
+    def __init__(self, vector=None, matrix=None):
+        self.vector = np.zeros(shape=(3,1)) if vector is None else vector
+        self.matrix = np.zeros(shape=(3,3)) if matrix is None else matrix
 
     def __add__(self, other):
         return InfoState3(self.vector + other.vector, self.matrix + other.matrix)
@@ -31,9 +32,9 @@ class InfoState3:
         self.matrix.fill(0)
 
 class InfoState6:
-    def __init__(self, vector=np.zeros(shape=(6,1)), matrix=np.zeros(shape=(6,6))):
-        self.vector = vector
-        self.matrix = matrix
+    def __init__(self, vector=None, matrix=None):
+        self.vector = np.zeros(shape=(6,1)) if vector is None else vector
+        self.matrix = np.zeros(shape=(6,6)) if matrix is None else matrix
 
     def __add__(self, other):
         return InfoState6(self.vector + other.vector, self.matrix + other.matrix)
@@ -45,6 +46,117 @@ class InfoState6:
         self.vector.fill(0)
         self.matrix.fill(0)
 
+class InfoStateView:
+    # InfoState-like access to one entry of an InfoStatePool
+    # reads and writes go straight through to the pool arrays
+    def __init__(self, pool, idx):
+        self.pool = pool
+        self.idx = idx
+
+    @property
+    def vector(self):
+        return self.pool.vectors[self.idx]
+
+    @vector.setter
+    def vector(self, vector):
+        self.pool.vectors[self.idx] = vector
+
+    @property
+    def matrix(self):
+        return self.pool.matrices[self.idx]
+
+    @matrix.setter
+    def matrix(self, matrix):
+        self.pool.matrices[self.idx] = matrix
+
+    def clear(self):
+        self.pool.clear(self.idx)
+
+# information vectors and matrices of N variables of the same dof,
+# stored contiguously as (N,dof,1) and (N,dof,dof) arrays
+#
+# idxs can be a single index or an array of indices everywhere below,
+# repeated indices accumulate in add and subtract
+class InfoStatePool:
+    def __init__(self, dof, capacity = 64, allocator = None, name = "info_states"):
+        self.dof = dof
+        self.allocator = allocator or HeapAllocator()
+        self.name = name
+        self.size = 0
+        self.capacity = 0
+        self.vector_buffer = np.zeros((0,dof,1))
+        self.matrix_buffer = np.zeros((0,dof,dof))
+        self.reserve(capacity)
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+        vector_buffer = self.allocator.allocate(self.name + ".vectors", (capacity,self.dof,1), np.float64)
+        matrix_buffer = self.allocator.allocate(self.name + ".matrices", (capacity,self.dof,self.dof), np.float64)
+        vector_buffer[:self.size] = self.vectors
+        matrix_buffer[:self.size] = self.matrices
+        self.vector_buffer = vector_buffer
+        self.matrix_buffer = matrix_buffer
+        self.capacity = capacity
+
+    def append(self, count = 1):
+        # appends count cleared entries, returns the index of the first one
+        if self.size + count > self.capacity:
+            self.reserve(max(2*self.capacity, self.size + count))
+        start = self.size
+        self.size += count
+        self.clear(np.arange(start, self.size))
+        return start
+
+    @property
+    def vectors(self):
+        return self.vector_buffer[:self.size]
+
+    @property
+    def matrices(self):
+        return self.matrix_buffer[:self.size]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.size
+        if idx < 0 or idx >= self.size:
+            raise IndexError("info state index out of range", idx)
+        return InfoStateView(self, idx)
+
+    def __iter__(self):
+        for idx in range(self.size):
+            yield InfoStateView(self, idx)
+
+    def set(self, idxs, vectors, matrices):
+        self.vectors[idxs] = vectors
+        self.matrices[idxs] = matrices
+
+    def add(self, idxs, vectors, matrices):
+        if np.isscalar(idxs):
+            self.vectors[idxs] += vectors
+            self.matrices[idxs] += matrices
+        else:
+            np.add.at(self.vectors, idxs, vectors)
+            np.add.at(self.matrices, idxs, matrices)
+
+    def subtract(self, idxs, vectors, matrices):
+        if np.isscalar(idxs):
+            self.vectors[idxs] -= vectors
+            self.matrices[idxs] -= matrices
+        else:
+            np.subtract.at(self.vectors, idxs, vectors)
+            np.subtract.at(self.matrices, idxs, matrices)
+
+    def clear(self, idxs = None, prior = 0.0):
+        # zero the vectors and set the matrices to prior * identity
+        if idxs is None:
+            idxs = slice(None)
+        self.vectors[idxs] = 0
+        self.matrices[idxs] = prior * np.eye(self.dof)
+
 if __name__ == "__main__":
     rng = np.random.default_rng(0)
 
@@ -62,3 +174,12 @@ if __name__ == "__main__":
 
     x += y
     print("x updated vect", x.vector)
+
+    pool = InfoStatePool(3, capacity=2)
+    pool.append(5)
+    pool.add(np.array([0, 2, 2]), np.ones((3,3,1)), np.ones((3,3,3)))
+    pool.subtract(1, y.vector, y.matrix)
+    print("pool vects", pool.vectors[:,:,0])
+    pool.clear(2, prior=10)
+    pool[0].matrix = 2 * np.eye(3)
+    print("pool mats", pool.matrices)
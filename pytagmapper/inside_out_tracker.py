@@ -1,8 +1,10 @@
 import numpy as np
+import cv2
 from pytagmapper.geometry import *
 from pytagmapper.project import *
 from pytagmapper.data import *
 from pytagmapper.heuristics import *
+from pytagmapper.tag_grid import TagGrid, get_frustum_planes
 
 def look_at_origin(from_xyz, up_dir):
     from_xyz = np.array(from_xyz, dtype=np.float64)
@@ -57,7 +59,8 @@ INIT_TXS_WORLD_VIEWPOINT = [
 
 class InsideOutTracker:
     def __init__(self, camera_matrix, map_data,
-                 tx_world_viewpoint = None, max_regularizer = 1e9):
+                 tx_world_viewpoint = None, max_regularizer = 1e9,
+                 prune_ratio = 100.0, prune_after = 3, pnp_init = True):
         self.tag_locations = map_data['tag_locations']        
         self.camera_matrix = np.array(camera_matrix)
         self.tag_side_lengths = map_data['tag_side_lengths']
@@ -73,6 +76,15 @@ class InsideOutTracker:
         for tag_id, tx_world_tag in self.tag_locations.items():
             self.txs_world_tag[tag_id] = np.array(tx_world_tag)
 
+        # world corners of every tag (T, 4, 3), row tag_rows[tag_id]
+        # the map does not move, so these are only computed once
+        self.tag_ids = list(self.txs_world_tag.keys())
+        self.tag_rows = { tag_id: row for row, tag_id in enumerate(self.tag_ids) }
+        self.world_corners = np.zeros((len(self.tag_ids), 4, 3))
+        for row, tag_id in enumerate(self.tag_ids):
+            self.world_corners[row] = (self.txs_world_tag[tag_id] @ self.get_corners_mat(tag_id))[:3,:].T
+        self.tag_grid = TagGrid(self.world_corners)
+
         self.tx_world_viewpoint = tx_world_viewpoint
         if self.tx_world_viewpoint is None:
             init_dist = 10 * self.default_tag_side_length
@@ -89,19 +101,55 @@ class InsideOutTracker:
         self.max_regularizer = max_regularizer
         self.regularizer = self.max_regularizer        
 
-        self.txs_world_viewpoint = [tx.copy() for tx in INIT_TXS_WORLD_VIEWPOINT]
-        for tx in self.txs_world_viewpoint:
-            tx[:3,3] *= self.default_tag_side_length * 10
-        self.num_hypotheses = len(self.txs_world_viewpoint)
-        self.errors = [float('inf') for _ in range(self.num_hypotheses)]
-        self.regularizers = [self.max_regularizer for _ in range(self.num_hypotheses)]
+        # one entry per hypothesis, so that they can all be updated at once
+        # the hypotheses from INIT_TXS_WORLD_VIEWPOINT, then one more for
+        # the pose from pnp, see init_pnp
+        self.num_hypotheses = len(INIT_TXS_WORLD_VIEWPOINT)
+        self.pnp_guess = self.num_hypotheses
+        self.txs_world_viewpoint = np.array(INIT_TXS_WORLD_VIEWPOINT + [self.tx_world_viewpoint])
+        self.txs_world_viewpoint[:self.num_hypotheses,:3,3] *= self.default_tag_side_length * 10
+        self.errors = np.full(self.num_hypotheses + 1, float('inf'))
+        self.regularizers = np.full(self.num_hypotheses + 1, float(self.max_regularizer))
+        self.behind_camera = np.zeros(self.num_hypotheses + 1, dtype=bool)
         self.converged_guess = None
         self.best_guess = 0
 
+        # racing the hypotheses before convergence
+        # after prune_after iterations, a hypothesis is dropped once its
+        # error is more than prune_ratio times the best error, or it has
+        # a detected tag behind the camera. prune_ratio None keeps them all
+        self.prune_ratio = prune_ratio
+        self.prune_after = prune_after
+        self.active_hypotheses = np.arange(self.num_hypotheses)
+        self.num_init_its = 0 # iterations before convergence
+
+        # with pnp_init, the tracker starts from a pnp solve on the map
+        # corners whenever there are at least 2 tags, and goes back to it
+        # when the tracked error gets over max_pt_error per corner (eg the
+        # camera moved while the tags were covered). the hypotheses are
+        # only used when pnp fails
+        self.pnp_init = pnp_init
+        self.max_pt_error = 30
+
+        # counters
+        self.num_pnp_inits = 0
+        self.num_evaluations = 0 # hypothesis updates, summed over iterations
+        self.num_pruned = 0
+
     def get_corners_mat(self, tag_id):
         return self.corners_mats.get(tag_id, self.default_corners_mat)
 
-    def get_projections(self, guess_idx=-1):
+    def get_camera_corners(self, txs_world_viewpoint, rows):
+        # world_corners[rows] in the frame of each of the (H, 4, 4) viewpoints
+        # returns (H, len(rows), 4, 3)
+        txs_viewpoint_world = SE3_inv_batch(txs_world_viewpoint)
+        rotations = txs_viewpoint_world[:,None,:3,:3].transpose(0,1,3,2)
+        translations = txs_viewpoint_world[:,None,None,:3,3]
+        return self.world_corners[rows] @ rotations + translations
+
+    def get_projections(self, guess_idx=-1, image_size=None):
+        # with image_size (width, height), only the tags that can be in
+        # the image are projected, see tag_grid.py
         tag_ids = []
         tag_corners =[]
 
@@ -110,86 +158,191 @@ class InsideOutTracker:
         else:
             tx_world_viewpoint = self.tx_world_viewpoint
 
-        for tag_id, tx_world_tag in self.txs_world_tag.items():
-            tx_viewpoint_tag = SE3_inv(tx_world_viewpoint) @ tx_world_tag
-            projected_corners, _, _ = project(self.camera_matrix, tx_viewpoint_tag, self.get_corners_mat(tag_id))
-            tag_ids.append(tag_id)
-            tag_corners.append(projected_corners)
-
-        return tag_ids, tag_corners
-
-    def update_guess(self, guess_idx, tags, force_update = False):
-        tx_world_viewpoint = self.txs_world_viewpoint[guess_idx]
-        error = self.errors[guess_idx]
-        regularizer = self.regularizers[guess_idx]
-        
-        JtJ = np.zeros((6,6))
-        rtJ = np.zeros((1,6))
-        curr_error = 0
-
-        for tag_id, corners in tags:
-            tx_world_tag = self.txs_world_tag.get(tag_id, None)
-            if tx_world_tag is None:
-                continue
-
-            corners = np.array(corners).reshape((8,1))
-            tx_viewpoint_tag = SE3_inv(tx_world_viewpoint) @ tx_world_tag
-            projected_corners, dcorners_dcamera, _ = project(self.camera_matrix, tx_viewpoint_tag, self.get_corners_mat(tag_id))
+        if not self.txs_world_tag:
+            return tag_ids, tag_corners
 
-            residual = projected_corners - corners
-            JtJ += dcorners_dcamera.T @ dcorners_dcamera
-            rtJ += residual.T @ dcorners_dcamera
-            curr_error += (residual.T @ residual)[0,0]
-
-        if curr_error > error:
-            regularizer *= 25
+        if image_size is None:
+            rows = np.arange(len(self.tag_ids))
         else:
-            regularizer *= 0.5
+            planes = get_frustum_planes(self.camera_matrix, image_size, tx_world_viewpoint)
+            rows = self.tag_grid.query(planes)
+
+        camera_corners = self.get_camera_corners(tx_world_viewpoint[None], rows)[0]
+        if image_size is not None:
+            # partly behind the camera
+            in_front = np.all(camera_corners[:,:,2] > 0, axis=1)
+            rows = rows[in_front]
+            camera_corners = camera_corners[in_front]
 
-        improved = curr_error < error
+        tag_ids = [self.tag_ids[row] for row in rows]
+        projected_corners, _ = project_points(self.camera_matrix, camera_corners)
+        tag_corners = list(projected_corners.reshape((len(tag_ids),8,1)))
 
-        regularizer = min(regularizer, self.max_regularizer)
-        regularizer = max(regularizer, 1e-3)
+        return tag_ids, tag_corners
 
-        if improved or force_update:
-            update = np.linalg.solve(JtJ + regularizer * np.eye(6), -rtJ.T)
-            tx_world_viewpoint = tx_world_viewpoint @ se3_exp(update)
+    def update_guess(self, guess_idx, tags, force_update = False):
+        self.update_guesses([guess_idx], tags, force_update)
+
+    def update_guesses(self, guess_idxs, tags, force_update = False):
+        # one damped gauss newton step for each of the guess_idxs hypotheses
+        # every hypothesis against every detected tag in the map at once
+        #   residuals (H, T, 8, 1), jacobians (H, T, 8, 6) => JtJ (H, 6, 6)
+        guess_idxs = np.asarray(guess_idxs)
+        txs_world_viewpoint = self.txs_world_viewpoint[guess_idxs]
+        errors = self.errors[guess_idxs]
+        regularizers = self.regularizers[guess_idxs]
+        num_guesses = len(guess_idxs)
+
+        tags = [(tag_id, corners) for tag_id, corners in tags if tag_id in self.txs_world_tag]
+        JtJ = np.zeros((num_guesses,6,6))
+        rtJ = np.zeros((num_guesses,1,6))
+        curr_errors = np.zeros(num_guesses)
+
+        if tags:
+            rows = [self.tag_rows[tag_id] for tag_id, _ in tags]
+            corners = np.array([np.array(corners).reshape((8,1)) for _, corners in tags])
+            num_tags = len(tags)
+
+            camera_corners = self.get_camera_corners(txs_world_viewpoint, rows) # H x T x 4 x 3
+            projected_corners, dcorners_dcamera = project_points(self.camera_matrix, camera_corners)
+            residuals = projected_corners.reshape((num_guesses,num_tags,8,1)) - corners
+            dcorners_dcamera = dcorners_dcamera.reshape((num_guesses,num_tags*8,6))
+            residuals = residuals.reshape((num_guesses,num_tags*8,1))
+
+            JtJ = dcorners_dcamera.transpose(0,2,1) @ dcorners_dcamera
+            rtJ = residuals.transpose(0,2,1) @ dcorners_dcamera
+            curr_errors = np.sum(residuals[:,:,0]**2, axis=1)
+            self.behind_camera[guess_idxs] = np.any(camera_corners[...,2] <= 0, axis=(1,2))
+
+        regularizers = np.where(curr_errors > errors, regularizers * 25, regularizers * 0.5)
+        improved = curr_errors < errors
+
+        regularizers = np.minimum(regularizers, self.max_regularizer)
+        regularizers = np.maximum(regularizers, 1e-3)
+
+        step = improved | force_update
+        if np.any(step):
+            updates = np.linalg.solve(JtJ[step] + regularizers[step,None,None] * np.eye(6),
+                                      -rtJ[step].transpose(0,2,1))
+            txs_world_viewpoint[step] = txs_world_viewpoint[step] @ se3_exp_batch(updates)
             # tx_world_viewpoint = heuristic_flip_tx_world_cam(tx_world_viewpoint @ se3_exp(update))
 
-        error = curr_error
+        self.txs_world_viewpoint[guess_idxs] = txs_world_viewpoint
+        self.regularizers[guess_idxs] = regularizers
+        self.errors[guess_idxs] = curr_errors
 
-        self.txs_world_viewpoint[guess_idx] = tx_world_viewpoint
-        self.regularizers[guess_idx] = regularizer
-        self.errors[guess_idx] = error
+    def get_pnp_pose(self, tags):
+        # ransac pnp from the corners of the detected map tags
+        # returns tx_world_viewpoint, or None if it failed
+        rows = []
+        image_corners = []
+        for tag_id, corners in tags:
+            if tag_id not in self.tag_rows:
+                continue
+            rows.append(self.tag_rows[tag_id])
+            image_corners.append(np.array(corners, dtype=np.float64).reshape((4,2)))
+        if len(rows) < 2:
+            return None
+
+        world_corners = self.world_corners[rows].reshape((-1,3))
+        image_corners = np.concatenate(image_corners)
+        succ, rvec, tvec, inliers = cv2.solvePnPRansac(
+            world_corners, image_corners, self.camera_matrix, None,
+            reprojectionError = self.max_pt_error)
+        if not succ:
+            return None
+        rot, _ = cv2.Rodrigues(rvec)
+        tx_viewpoint_world = np.eye(4)
+        tx_viewpoint_world[:3,:3] = rot
+        tx_viewpoint_world[:3,3:4] = tvec
+        return SE3_inv(tx_viewpoint_world)
+
+    def init_pnp(self, tags, force_update = False):
+        # moves the pnp hypothesis to the pnp pose and takes a step from
+        # there, returns False and leaves everything as it was if pnp failed
+        # or its error is over max_pt_error
+        tx_world_viewpoint = self.get_pnp_pose(tags)
+        if tx_world_viewpoint is None:
+            return False
+
+        prev_state = (self.txs_world_viewpoint[self.pnp_guess].copy(),
+                      self.errors[self.pnp_guess],
+                      self.regularizers[self.pnp_guess])
+        self.txs_world_viewpoint[self.pnp_guess] = tx_world_viewpoint
+        self.errors[self.pnp_guess] = float('inf')
+        self.regularizers[self.pnp_guess] = 1e-3 # already close
+        self.update_guess(self.pnp_guess, tags, force_update)
+
+        num_tags = len([t for t, c in tags if t in self.txs_world_tag])
+        if self.errors[self.pnp_guess] / (num_tags * 4) > self.max_pt_error:
+            self.txs_world_viewpoint[self.pnp_guess], self.errors[self.pnp_guess], \
+                self.regularizers[self.pnp_guess] = prev_state
+            return False
+
+        self.converged_guess = self.pnp_guess
+        self.num_pnp_inits += 1
+        self.reset_hypotheses()
+        return True
 
     def update1(self, tags, force_update = False):
-        if self.converged_guess is not None:
+        tags = list(tags)
+        if self.converged_guess is None and self.pnp_init and self.init_pnp(tags, force_update):
+            best_guess = self.converged_guess
+        elif self.converged_guess is not None:
             self.update_guess(self.converged_guess, tags, force_update)
             best_guess = self.converged_guess
+
+            # lost track, start over from pnp
+            num_tags = len([t for t, c in tags if t in self.txs_world_tag])
+            if self.pnp_init and num_tags >= 2 and \
+               self.errors[best_guess] / (num_tags * 4) > self.max_pt_error and \
+               self.init_pnp(tags, force_update):
+                best_guess = self.converged_guess
         else:
-            for i in range(self.num_hypotheses):
-                self.update_guess(i, tags, force_update)
+            self.update_guesses(self.active_hypotheses, tags, force_update)
+            self.num_init_its += 1
+            self.num_evaluations += len(self.active_hypotheses)
 
             # report the tx with the best error
-            best_guess = 0
+            best_guess = self.active_hypotheses[0]
             best_error = float('inf')
-            for i, error in enumerate(self.errors):
-                if error < best_error:
+            for i in self.active_hypotheses:
+                if self.errors[i] < best_error:
                     best_guess = i
-                    best_error = error
+                    best_error = self.errors[i]
 
             # heuristic to check convergence
+            # a single tag fits a mirrored pose about as well as the true
+            # one, so its errors can't tell the hypotheses apart and they
+            # are only pruned on frames with at least 2 tags
             num_tags = len([t for t, c in tags if t in self.txs_world_tag])
             if num_tags >= 2:
                 pt_error = best_error / (num_tags * 4)
-                if pt_error <= 30: # px
+                if pt_error <= self.max_pt_error: # px
                     self.converged_guess = best_guess
+                self.prune_hypotheses(best_guess)
 
         self.error = self.errors[best_guess]
-        self.tx_world_viewpoint = self.txs_world_viewpoint[best_guess]
+        self.tx_world_viewpoint = self.txs_world_viewpoint[best_guess].copy()
         self.regularizer = self.regularizers[best_guess]
         self.best_guess = best_guess
 
+    def reset_hypotheses(self):
+        # initialization started over, the next race starts again
+        # from every hypothesis
+        self.active_hypotheses = np.arange(self.num_hypotheses)
+        self.num_init_its = 0
+
+    def prune_hypotheses(self, best_guess):
+        if self.prune_ratio is None or self.num_init_its < self.prune_after:
+            return
+        active = self.active_hypotheses
+        keep = (self.errors[active] <= self.prune_ratio * self.errors[best_guess]) & \
+            ~self.behind_camera[active]
+        keep[active == best_guess] = True
+        self.num_pruned += len(active) - np.count_nonzero(keep)
+        self.active_hypotheses = active[keep]
+
     def update(self, tag_ids, tag_corners, force_update = False):
         return self.update1(list(zip(tag_ids, tag_corners)), force_update)
 
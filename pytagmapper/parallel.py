@@ -0,0 +1,307 @@
+import numpy as np
+import multiprocessing
+import signal
+from multiprocessing import resource_tracker
+from collections import deque
+from pytagmapper.map_builder import detection_to_viewpoint_msgs_batch, detection_to_tag_msgs_batch
+from pytagmapper.shared_state import SharedMap
+
+# multi-process synchronous gbp for a MapBuilder
+#
+# the tags are split into partitions of co-visible tags, and every
+# detection goes to the partition of its tag, so a tag belief only ever
+# depends on the messages of one worker
+#
+#   worker 0          worker 1
+#   ( tag )__[det]__( view )__[det]__( tag )
+#   ( tag )__[det]__/      \__[det]__( tag )
+#
+# viewpoints that see tags of several partitions are the boundary,
+# each viewpoint is owned by one worker, which sums the messages
+# of all its detections from whichever worker sent them
+#
+# one sweep is
+#  A) every worker sends detection to viewpoint msgs for its detections
+#  -- barrier --
+#  B) every worker sums the beliefs of the viewpoints it owns
+#  -- barrier --
+#  C) every worker sends detection to tag msgs for its detections
+#     and sums the beliefs of its tags
+#
+# the workers attach to the shared memory arrays of the MapBuilder itself
+# (see MapBuilder(shared_memory = True)) and only write to the rows they
+# own, so nothing is copied and the only exchange between partitions is
+# the boundary viewpoint beliefs read in C
+
+def partition_tags(tag_idxs, viewpoint_idxs, num_tags, num_partitions):
+    # returns the partition of each tag
+    #
+    # tags are visited breadth first over the covisibility graph (two tags
+    # are adjacent if some viewpoint sees both) so that neighboring tags
+    # end up next to each other, and that order is cut into pieces with
+    # about the same number of detections
+    tag_viewpoints = [[] for _ in range(num_tags)]
+    viewpoint_tags = {}
+    for tag_idx, viewpoint_idx in zip(tag_idxs, viewpoint_idxs):
+        tag_viewpoints[tag_idx].append(viewpoint_idx)
+        viewpoint_tags.setdefault(viewpoint_idx, []).append(tag_idx)
+
+    order = []
+    visited = np.zeros(num_tags, dtype=bool)
+    for root in range(num_tags):
+        if visited[root]:
+            continue
+        visited[root] = True
+        queue = deque([root])
+        while queue:
+            tag_idx = queue.popleft()
+            order.append(tag_idx)
+            for viewpoint_idx in tag_viewpoints[tag_idx]:
+                for other_tag_idx in viewpoint_tags[viewpoint_idx]:
+                    if not visited[other_tag_idx]:
+                        visited[other_tag_idx] = True
+                        queue.append(other_tag_idx)
+
+    tag_num_detections = np.bincount(tag_idxs, minlength=num_tags)
+    cumulative = np.cumsum(tag_num_detections[order])
+    total = max(np.sum(tag_num_detections), 1)
+    tag_partitions = np.empty(num_tags, dtype=np.int64)
+    tag_partitions[order] = np.minimum(
+        (cumulative - tag_num_detections[order]) * num_partitions // total,
+        num_partitions - 1)
+    return tag_partitions
+
+def run_sweeps(shared_map, job, barrier, num_sweeps, regularizer, anchor_prior):
+    dets = job['detections']
+    tag_idxs = shared_map['detections.tag_idxs'][dets]
+    viewpoint_idxs = shared_map['detections.viewpoint_idxs'][dets]
+    JtJs = shared_map['detections.JtJs'][dets]
+    rtJs = shared_map['detections.rtJs'][dets]
+
+    viewpoint_vectors = shared_map['viewpoint_infos.vectors']
+    viewpoint_matrices = shared_map['viewpoint_infos.matrices']
+    tag_vectors = shared_map['tag_infos.vectors']
+    tag_matrices = shared_map['tag_infos.matrices']
+    viewpoint_msg_vectors = shared_map['detection_to_viewpoint_msgs.vectors']
+    viewpoint_msg_matrices = shared_map['detection_to_viewpoint_msgs.matrices']
+    tag_msg_vectors = shared_map['detection_to_tag_msgs.vectors']
+    tag_msg_matrices = shared_map['detection_to_tag_msgs.matrices']
+
+    owned_tags = job['tags']
+    owned_viewpoints = job['viewpoints']
+    owned_viewpoint_dets = job['viewpoint_detections']
+    owned_viewpoint_det_idxs = shared_map['detections.viewpoint_idxs'][owned_viewpoint_dets]
+    tag_priors = np.tile(regularizer * np.eye(tag_matrices.shape[1]), (len(owned_tags),1,1))
+    tag_priors[owned_tags == 0] += anchor_prior * np.eye(tag_matrices.shape[1])
+    viewpoint_prior = regularizer * np.eye(6)
+
+    for _ in range(num_sweeps):
+        # A) detection to viewpoint msgs
+        if len(dets):
+            vector_msgs, matrix_msgs = detection_to_viewpoint_msgs_batch(
+                JtJs, rtJs,
+                tag_vectors[tag_idxs] - tag_msg_vectors[dets],
+                tag_matrices[tag_idxs] - tag_msg_matrices[dets])
+            viewpoint_msg_vectors[dets] = vector_msgs
+            viewpoint_msg_matrices[dets] = matrix_msgs
+        barrier.wait()
+
+        # B) beliefs of the owned viewpoints from all of their msgs
+        viewpoint_vectors[owned_viewpoints] = 0
+        viewpoint_matrices[owned_viewpoints] = viewpoint_prior
+        np.add.at(viewpoint_vectors, owned_viewpoint_det_idxs, viewpoint_msg_vectors[owned_viewpoint_dets])
+        np.add.at(viewpoint_matrices, owned_viewpoint_det_idxs, viewpoint_msg_matrices[owned_viewpoint_dets])
+        barrier.wait()
+
+        # C) detection to tag msgs, and the beliefs of the owned tags
+        tag_vectors[owned_tags] = 0
+        tag_matrices[owned_tags] = tag_priors
+        if len(dets):
+            vector_msgs, matrix_msgs = detection_to_tag_msgs_batch(
+                JtJs, rtJs,
+                viewpoint_vectors[viewpoint_idxs] - viewpoint_msg_vectors[dets],
+                viewpoint_matrices[viewpoint_idxs] - viewpoint_msg_matrices[dets])
+            tag_msg_vectors[dets] = vector_msgs
+            tag_msg_matrices[dets] = matrix_msgs
+            np.add.at(tag_vectors, tag_idxs, vector_msgs)
+            np.add.at(tag_matrices, tag_idxs, matrix_msgs)
+
+        # the next A only reads the beliefs of the owned tags
+        # but the viewpoint beliefs are rewritten in B, so every
+        # worker has to be done with C before anyone gets there
+        barrier.wait()
+
+def worker_main(conn, barrier):
+    # ctrl+c is for the main process, see ParallelMessagePasser.wait
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    shared_map = None
+    job = None
+    while True:
+        command = conn.recv()
+        if command[0] == "layout":
+            _, descriptor, job = command
+            if shared_map is not None:
+                shared_map.close()
+            shared_map = SharedMap(descriptor)
+            conn.send("ok")
+        elif command[0] == "sweep":
+            _, num_sweeps, regularizer, anchor_prior = command
+            try:
+                run_sweeps(shared_map, job, barrier, num_sweeps, regularizer, anchor_prior)
+            except Exception as e:
+                barrier.abort()
+                conn.send(("error", repr(e)))
+                continue
+            conn.send("ok")
+        elif command[0] == "stop":
+            break
+        else:
+            raise RuntimeError("Unknown command", command[0])
+
+    if shared_map is not None:
+        shared_map.close()
+    conn.close()
+
+class ParallelMessagePasser:
+    # runs the synchronous message passing sweeps of a MapBuilder
+    # across num_workers processes
+    #
+    #   map_builder = MapBuilder(..., shared_memory = True)
+    #   passer = ParallelMessagePasser(map_builder, 4)
+    #   passer.sweep(20) # instead of 20 send_detection_to_*_msgs() calls
+    #   map_builder.update()
+    #   ...
+    #   passer.close()
+    def __init__(self, map_builder, num_workers):
+        if num_workers < 1:
+            raise RuntimeError("Need at least one worker", num_workers)
+        if not map_builder.shared_memory:
+            raise RuntimeError("ParallelMessagePasser needs MapBuilder(shared_memory = True)")
+        self.map_builder = map_builder
+        self.num_workers = num_workers
+
+        # make sure the resource tracker is running before forking so that
+        # the workers share it with this process, otherwise each worker gets
+        # its own tracker, which tries to clean up the shared memory it
+        # attached to on exit
+        resource_tracker.ensure_running()
+
+        self.barrier = multiprocessing.Barrier(num_workers)
+        self.conns = []
+        self.workers = []
+        for _ in range(num_workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=worker_main, args=(child_conn, self.barrier), daemon=True)
+            worker.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.workers.append(worker)
+
+        self.layout_key = None
+
+    def make_layout(self):
+        map_builder = self.map_builder
+        store = map_builder.detection_store
+        num_viewpoints = len(map_builder.viewpoint_ids)
+        num_tags = len(map_builder.tag_ids)
+
+        tag_partitions = partition_tags(store.tag_idxs, store.viewpoint_idxs,
+                                        num_tags, self.num_workers)
+        det_partitions = tag_partitions[store.tag_idxs]
+
+        # each viewpoint is owned by the partition with most of its detections
+        viewpoint_partition_counts = np.zeros((num_viewpoints, self.num_workers), dtype=np.int64)
+        np.add.at(viewpoint_partition_counts, (store.viewpoint_idxs, det_partitions), 1)
+        viewpoint_partitions = np.argmax(viewpoint_partition_counts, axis=1)
+
+        descriptor = map_builder.get_shared_descriptor()
+        for worker_idx, conn in enumerate(self.conns):
+            job = {
+                'detections': np.nonzero(det_partitions == worker_idx)[0],
+                'tags': np.nonzero(tag_partitions == worker_idx)[0],
+                'viewpoints': np.nonzero(viewpoint_partitions == worker_idx)[0],
+                'viewpoint_detections': np.nonzero(viewpoint_partitions[store.viewpoint_idxs] == worker_idx)[0],
+            }
+            conn.send(("layout", descriptor, job))
+        self.wait()
+
+        # the workers have let go of the blocks of the previous generation
+        map_builder.allocator.release_retired()
+
+    def wait(self):
+        replies = []
+        try:
+            for conn in self.conns:
+                replies.append(conn.recv())
+        except KeyboardInterrupt:
+            # let the workers finish so that the next command starts in sync
+            for conn in self.conns[len(replies):]:
+                conn.recv()
+            raise
+
+        errors = [reply for reply in replies if reply != "ok"]
+        if errors:
+            self.barrier.reset()
+            raise RuntimeError("Worker failed", errors)
+
+    def sweep(self, num_sweeps):
+        # the workers read and write the arrays of the map builder directly
+        # they only have to be told again when the graph has grown, or
+        # an array has been moved to a bigger block
+        map_builder = self.map_builder
+        layout_key = (map_builder.allocator.get_generation(),
+                      len(map_builder.detection_store),
+                      len(map_builder.viewpoint_ids),
+                      len(map_builder.tag_ids))
+        if layout_key != self.layout_key:
+            self.make_layout()
+            self.layout_key = layout_key
+
+        # the workers rebuild the beliefs on top of the current regularizer
+        map_builder.sync_priors()
+        for conn in self.conns:
+            conn.send(("sweep", num_sweeps, map_builder.regularizer, map_builder.get_anchor_prior()))
+        self.wait()
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(("stop",))
+        for worker in self.workers:
+            worker.join()
+
+if __name__ == "__main__":
+    import os
+    from pytagmapper import data
+    from pytagmapper.map_builder import MapBuilder
+
+    scene_data = data.load_data(os.path.join(os.path.dirname(__file__), "..", "example_data"))
+
+    def make_map_builder(shared_memory):
+        map_builder = MapBuilder(scene_data['camera_matrix'],
+                                 scene_data['tag_side_lengths'],
+                                 "3d",
+                                 message_passing="synchronous",
+                                 shared_memory=shared_memory)
+        for viewpoint_id in sorted(scene_data['viewpoints'].keys(), key=int)[:6]:
+            map_builder.add_viewpoint(viewpoint_id, scene_data['viewpoints'][viewpoint_id])
+        map_builder.relinearize()
+        return map_builder
+
+    serial_map_builder = make_map_builder(False)
+    for i in range(20):
+        serial_map_builder.send_detection_to_viewpoint_msgs()
+        serial_map_builder.send_detection_to_tag_msgs()
+
+    map_builder = make_map_builder(True)
+    passer = ParallelMessagePasser(map_builder, 3)
+    passer.sweep(20)
+    passer.close()
+
+    for name in ['viewpoint_infos', 'tag_infos']:
+        serial = getattr(serial_map_builder, name)
+        parallel = getattr(map_builder, name)
+        print(name, "parallel vs serial max relative delta",
+              np.max(np.abs(serial.vectors - parallel.vectors)) / np.max(np.abs(serial.vectors)),
+              np.max(np.abs(serial.matrices - parallel.matrices)) / np.max(np.abs(serial.matrices)))
+    map_builder.close()
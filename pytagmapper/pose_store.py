@@ -0,0 +1,66 @@
+import numpy as np
+from pytagmapper.shared_state import HeapAllocator
+
+# growable (N, dim, dim) array of poses with list-style access
+#
+# poses[i] is a view of row i, so fix_SE3(poses[i]) fixes it in place
+# and poses[i] = tx writes into the array, poses.array is a view of all
+# the live rows for batched operations
+#
+# capacity doubles whenever it runs out, like DetectionStore
+class PoseStore:
+    def __init__(self, dim, capacity = 64, allocator = None, name = "poses"):
+        self.dim = dim
+        self.allocator = allocator or HeapAllocator()
+        self.name = name
+        self.size = 0
+        self.capacity = 0
+        self.buffer = np.zeros((0,dim,dim))
+        self.reserve(capacity)
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+        buffer = self.allocator.allocate(self.name, (capacity,self.dim,self.dim), np.float64)
+        buffer[:self.size] = self.buffer[:self.size]
+        self.buffer = buffer
+        self.capacity = capacity
+
+    @property
+    def array(self):
+        return self.buffer[:self.size]
+
+    def append(self, tx):
+        # copy first, tx may be a view of this store
+        tx = np.array(tx, dtype=np.float64)
+        if self.size == self.capacity:
+            self.reserve(max(2*self.capacity, 1))
+        self.buffer[self.size] = tx
+        self.size += 1
+
+    def assign(self, txs):
+        # replace all of the poses
+        txs = np.array(txs, dtype=np.float64).reshape((-1,self.dim,self.dim))
+        self.reserve(len(txs))
+        self.buffer[:len(txs)] = txs
+        self.size = len(txs)
+
+    def check_idx(self, idx):
+        if idx < 0:
+            idx += self.size
+        if idx < 0 or idx >= self.size:
+            raise IndexError("pose index out of range", idx)
+        return idx
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        return self.buffer[self.check_idx(idx)]
+
+    def __setitem__(self, idx, tx):
+        self.buffer[self.check_idx(idx)] = tx
+
+    def __iter__(self):
+        for idx in range(self.size):
+            yield self.buffer[idx]
@@ -63,6 +63,67 @@ def project(camera_matrix, tx_camera_object, keypoints_mat):
 
     return image_kps, dimage_kps_dcamera, dimage_kps_dobject
 
+def project_points(camera_matrix, camera_points):
+    # camera_points is (..., n, 3), expressed in the camera frame
+    # returns image_points (..., n, 2) and the closed form
+    # dimage_points_dcamera (..., n, 2, 6)
+    #
+    # image = K p, homogenized to (u, v) = (x/z, y/z)
+    # d(u,v)/dp = (K[:2,:] - (u,v) ⊗ K[2,:]) / z
+    #
+    # the camera perturbation moves the point by dp = -(ω × p + v) = [p]x ω - v
+    # so each jacobian row a.T @ [ [p]x, -I ] becomes [ a × p, -a ]
+    image_points = camera_points @ camera_matrix.T # ... x n x 3
+    z = image_points[...,2:3]
+    image_points = image_points[...,:2] / z
+
+    dimage_dpoints = (camera_matrix[:2,:] -
+                      image_points[...,:,None] * camera_matrix[2,:]) / z[...,None] # ... x n x 2 x 3
+
+    dimage_points_dcamera = np.empty(dimage_dpoints.shape[:-1] + (6,))
+    dimage_points_dcamera[...,:3] = np.cross(dimage_dpoints, camera_points[...,None,:])
+    dimage_points_dcamera[...,3:] = -dimage_dpoints
+
+    return image_points, dimage_points_dcamera
+
+def project_batch_keypoints(camera_matrix, txs_camera_object, keypoints_mats):
+    # project_batch without the jacobians
+    # returns image_kps (N, 2n)
+    N = txs_camera_object.shape[0]
+    num_kps = keypoints_mats.shape[-1]
+
+    camera_kps = (txs_camera_object @ keypoints_mats)[:,:3,:].transpose(0,2,1) # N x num_kps x 3
+    image_kps = camera_kps @ camera_matrix.T
+    image_kps = image_kps[...,:2] / image_kps[...,2:3]
+    return image_kps.reshape((N,num_kps*2))
+
+def project_analytic(camera_matrix, tx_camera_object, keypoints_mat):
+    # same as project, but with the closed form jacobian from project_points
+    num_kps = keypoints_mat.shape[1]
+
+    camera_kps = (tx_camera_object @ keypoints_mat)[:3,:].T # num_kps x 3
+    image_kps, dimage_kps_dcamera = project_points(camera_matrix, camera_kps)
+    dimage_kps_dcamera = dimage_kps_dcamera.reshape((num_kps*2,6))
+    dimage_kps_dobject = dimage_kps_dcamera @ -SE3_adj(tx_camera_object)
+
+    return image_kps.reshape((num_kps*2,1)), dimage_kps_dcamera, dimage_kps_dobject
+
+def project_batch(camera_matrix, txs_camera_object, keypoints_mats):
+    # batched version of project_analytic
+    # txs_camera_object is (N, 4, 4)
+    # keypoints_mats is (4, n) shared by all poses or (N, 4, n)
+    # returns image_kps (N, 2n), dimage_kps_dcamera (N, 2n, 6),
+    # dimage_kps_dobject (N, 2n, 6)
+    N = txs_camera_object.shape[0]
+    num_kps = keypoints_mats.shape[-1]
+
+    camera_kps = (txs_camera_object @ keypoints_mats)[:,:3,:].transpose(0,2,1) # N x num_kps x 3
+    image_kps, dimage_kps_dcamera = project_points(camera_matrix, camera_kps)
+    dimage_kps_dcamera = dimage_kps_dcamera.reshape((N,num_kps*2,6))
+    dimage_kps_dobject = dimage_kps_dcamera @ -SE3_adj_batch(txs_camera_object)
+
+    return image_kps.reshape((N,num_kps*2)), dimage_kps_dcamera, dimage_kps_dobject
+
 if __name__ == "__main__":
     rng = np.random.default_rng(0)
     camera_matrix = np.array([
@@ -105,6 +166,28 @@ if __name__ == "__main__":
     print("deriv_c\n",deriv_c)
     print("delta_c\n",np.linalg.norm(deriv_c - deriv_c_numerical))
 
+    # check batched projection against the single pose version
+    txs_camera_tag = np.array([
+        tx_camera_tag @ se3_exp(rng.random((6,1)) * 0.1) for _ in range(5)
+    ])
+    batch_corners, batch_dcamera, batch_dtag = project_batch(camera_matrix, txs_camera_tag, corners_mat)
+    max_delta = 0
+    for i, tx in enumerate(txs_camera_tag):
+        image_corners, dimage_corners_dcamera, dimage_corners_dtag = project(camera_matrix, tx, corners_mat)
+        max_delta = max(max_delta,
+                        np.max(np.abs(batch_corners[i] - image_corners[:,0])),
+                        np.max(np.abs(batch_dcamera[i] - dimage_corners_dcamera)),
+                        np.max(np.abs(batch_dtag[i] - dimage_corners_dtag)))
+    print("batch vs single max delta\n", max_delta)
+
+    # check the closed form jacobian against the perturbation construction
+    image_corners, dimage_corners_dcamera, dimage_corners_dtag = project(camera_matrix, tx_camera_tag, corners_mat)
+    image_corners_a, dimage_corners_dcamera_a, dimage_corners_dtag_a = project_analytic(camera_matrix, tx_camera_tag, corners_mat)
+    print("analytic vs perturbation max delta\n",
+          max(np.max(np.abs(image_corners - image_corners_a)),
+              np.max(np.abs(dimage_corners_dcamera - dimage_corners_dcamera_a)),
+              np.max(np.abs(dimage_corners_dtag - dimage_corners_dtag_a))))
+
     
 
     
@@ -0,0 +1,91 @@
+import numpy as np
+
+# robust kernels for reprojection residuals
+# all functions act elementwise on residual arrays of any shape,
+# eg. (8,1) for one detection or (N,8,1) for a stack of detections
+#
+# the costs are scaled so that cost(r) ≈ r² for small r, matching the
+# plain least squares cost, and weight(r) = cost'(r) / 2r is the IRLS
+# weight applied to each row of the jacobian
+
+def huber_weights(k, residuals):
+    abs_residuals = np.abs(residuals)
+    outliers = abs_residuals > k
+    weights = np.ones(residuals.shape)
+    weights[outliers] = k/abs_residuals[outliers]
+    return weights
+
+def huber_errors(k, residuals):
+    abs_residuals = np.abs(residuals)
+    outliers = abs_residuals > k
+    errors = residuals**2
+    errors[outliers] = 2 * abs_residuals[outliers]*k - k**2
+    return errors
+
+def cauchy_weights(k, residuals):
+    if np.isinf(k):
+        return np.ones(residuals.shape)
+    return 1/(1 + (residuals/k)**2)
+
+def cauchy_errors(k, residuals):
+    if np.isinf(k):
+        return residuals**2
+    return k**2 * np.log1p((residuals/k)**2)
+
+def tukey_weights(k, residuals):
+    if np.isinf(k):
+        return np.ones(residuals.shape)
+    inliers = np.abs(residuals) <= k
+    return np.where(inliers, (1 - (residuals/k)**2)**2, 0.0)
+
+def tukey_errors(k, residuals):
+    if np.isinf(k):
+        return residuals**2
+    inliers = np.abs(residuals) <= k
+    return np.where(inliers, k**2/3 * (1 - (1 - (residuals/k)**2)**3), k**2/3)
+
+ROBUST_KERNELS = {
+    "huber": (huber_weights, huber_errors),
+    "cauchy": (cauchy_weights, cauchy_errors),
+    "tukey": (tukey_weights, tukey_errors),
+}
+
+def get_robust_kernel(name):
+    if name not in ROBUST_KERNELS:
+        raise RuntimeError("Unsupported robust kernel", name)
+    return ROBUST_KERNELS[name]
+
+def robust_normal_equations(kernel, k, residuals, jacobians):
+    # residuals is (..., m, 1), jacobians is (..., m, n)
+    # returns JtWJ (..., n, n), rtWJ (..., 1, n), and the total robust error (...)
+    # W is never formed, the weights scale the rows of J instead
+    weights_fn, errors_fn = get_robust_kernel(kernel)
+    weighted_jacobians = weights_fn(k, residuals) * jacobians
+    JtWJ = np.swapaxes(jacobians, -1, -2) @ weighted_jacobians
+    rtWJ = np.swapaxes(residuals, -1, -2) @ weighted_jacobians
+    error = np.sum(errors_fn(k, residuals), axis=(-2,-1))
+    return JtWJ, rtWJ, error
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    residuals = rng.normal(size=(5,8,1)) * 50
+    jacobians = rng.normal(size=(5,8,9))
+
+    for kernel in ROBUST_KERNELS:
+        JtWJ, rtWJ, error = robust_normal_equations(kernel, 30.0, residuals, jacobians)
+
+        # compare against the explicit diagonal weight matrix
+        weights_fn, errors_fn = get_robust_kernel(kernel)
+        max_delta = 0
+        for i in range(5):
+            W = np.diag(weights_fn(30.0, residuals[i])[:,0])
+            max_delta = max(max_delta,
+                            np.max(np.abs(jacobians[i].T @ W @ jacobians[i] - JtWJ[i])),
+                            np.max(np.abs(residuals[i].T @ W @ jacobians[i] - rtWJ[i])))
+        print(kernel, "row scaling vs diag matrix max delta", max_delta)
+
+        # weight should be cost'(r) / 2r
+        r = np.array([[5.0], [-45.0]])
+        epsilon = 1e-6
+        dcost = (errors_fn(30.0, r + epsilon) - errors_fn(30.0, r - epsilon)) / (2*epsilon)
+        print(kernel, "weight check", (dcost / (2*r)).T, weights_fn(30.0, r).T)
@@ -0,0 +1,173 @@
+import weakref
+import numpy as np
+from multiprocessing import shared_memory
+
+# allocators for the growable arrays of a MapBuilder
+#
+# every store (poses, detections, info states) allocates its arrays
+# through an allocator under a key like "viewpoint_infos.vectors"
+#
+# HeapAllocator gives ordinary numpy arrays
+# SharedAllocator puts each array in a multiprocessing.shared_memory block
+# so that other processes can map the live arrays of a MapBuilder without
+# copying anything, see SharedMapDescriptor and SharedMap
+#
+#   map_builder = MapBuilder(..., shared_memory = True)
+#   descriptor = map_builder.get_shared_descriptor() # small, picklable
+#   ...
+#   # in another process
+#   shared_map = SharedMap(descriptor)
+#   shared_map["txs_world_tag"] # (num_tags, 4, 4) view of the live poses
+#
+# shared memory blocks are registered with the resource tracker of the
+# process that created them, so attach from processes started through
+# multiprocessing (which share that tracker) rather than unrelated ones
+
+class HeapAllocator:
+    def allocate(self, key, shape, dtype, fill = 0):
+        return np.full(shape, fill, dtype=dtype)
+
+# the shared header holds these int64 fields
+HEADER_FIELDS = ['generation', 'num_viewpoints', 'num_tags', 'num_detections']
+
+# which header count gives the live rows of each block
+# the store name is the part of the key before the "."
+BLOCK_COUNTS = {
+    'txs_world_viewpoint': 'num_viewpoints',
+    'viewpoint_infos': 'num_viewpoints',
+    'txs_world_tag': 'num_tags',
+    'tag_infos': 'num_tags',
+    'corners_mats': 'num_tags',
+    'detections': 'num_detections',
+    'detection_to_viewpoint_msgs': 'num_detections',
+    'detection_to_tag_msgs': 'num_detections',
+}
+
+class SharedAllocator:
+    def __init__(self):
+        self.header_shm = shared_memory.SharedMemory(create=True, size=8*len(HEADER_FIELDS))
+        self.header = np.ndarray((len(HEADER_FIELDS),), dtype=np.int64, buffer=self.header_shm.buf)
+        self.header[:] = 0
+        self.blocks = {} # key => (shared memory, shape, dtype)
+        self.arrays = {} # key => weak reference to the array of the block
+
+        # blocks replaced by a bigger allocation, (shared memory, weak
+        # reference to its array). they are unlinked right away, but stay
+        # mapped until release_retired finds that no array in this process
+        # points into them anymore (views keep their base array alive)
+        self.retired = []
+
+    def allocate(self, key, shape, dtype, fill = 0):
+        nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        array[...] = fill
+
+        if key in self.blocks:
+            old_shm = self.blocks[key][0]
+            old_shm.unlink()
+            self.retired.append((old_shm, self.arrays[key]))
+        self.blocks[key] = (shm, tuple(shape), np.dtype(dtype).str)
+        self.arrays[key] = weakref.ref(array)
+
+        # every attached SharedMap is now out of date
+        self.header[HEADER_FIELDS.index('generation')] += 1
+
+        # the caller still copies out of the block it just outgrew, so this
+        # only releases the ones retired before it
+        self.release_retired()
+        return array
+
+    def release_retired(self):
+        # close the retired blocks that no array in this process uses
+        # anymore. the memory is freed once every other process that
+        # attached to a block has closed it as well, eg once the workers
+        # of a ParallelMessagePasser have moved on to the new generation
+        retired = []
+        for shm, array_ref in self.retired:
+            if array_ref() is None:
+                shm.close()
+            else:
+                retired.append((shm, array_ref))
+        self.retired = retired
+
+    def get_generation(self):
+        return int(self.header[HEADER_FIELDS.index('generation')])
+
+    def set_counts(self, num_viewpoints, num_tags, num_detections):
+        self.header[1:] = [num_viewpoints, num_tags, num_detections]
+
+    def get_descriptor(self, map_type, viewpoint_ids, tag_ids):
+        blocks = {}
+        for key, (shm, shape, dtype) in self.blocks.items():
+            blocks[key] = (shm.name, shape, dtype)
+        return SharedMapDescriptor(self.header_shm.name, blocks,
+                                   self.get_generation(), map_type, list(viewpoint_ids), list(tag_ids))
+
+    def close(self):
+        # arrays from this allocator must not be used after this
+        self.header = None
+        for shm, _ in self.retired:
+            shm.close()
+        for shm, _, _ in self.blocks.values():
+            shm.close()
+            shm.unlink()
+        self.header_shm.close()
+        self.header_shm.unlink()
+        self.retired = []
+        self.blocks = {}
+        self.arrays = {}
+
+class SharedMapDescriptor:
+    # everything needed to attach to the shared arrays of a MapBuilder
+    # the ids are a snapshot, the arrays themselves are live
+    def __init__(self, header_name, blocks, generation, map_type, viewpoint_ids, tag_ids):
+        self.header_name = header_name
+        self.blocks = blocks # key => (shared memory name, shape, dtype)
+        self.generation = generation
+        self.map_type = map_type
+        self.viewpoint_ids = viewpoint_ids
+        self.tag_ids = tag_ids
+
+class SharedMap:
+    # maps the shared arrays of a MapBuilder into this process
+    # shared_map[key] is a view of the live rows of that array
+    def __init__(self, descriptor):
+        self.descriptor = descriptor
+        self.header_shm = shared_memory.SharedMemory(name=descriptor.header_name)
+        self.header = np.ndarray((len(HEADER_FIELDS),), dtype=np.int64, buffer=self.header_shm.buf)
+        self.shms = []
+        self.arrays = {}
+        if not self.is_current():
+            self.close()
+            raise RuntimeError("Shared map was reallocated, attach with a new descriptor")
+        for key, (name, shape, dtype) in descriptor.blocks.items():
+            shm = shared_memory.SharedMemory(name=name)
+            self.shms.append(shm)
+            self.arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    def is_current(self):
+        # False once the MapBuilder has grown one of its arrays into a new
+        # block, the views here then no longer see its updates
+        return self.header[HEADER_FIELDS.index('generation')] == self.descriptor.generation
+
+    def get_count(self, name):
+        return int(self.header[HEADER_FIELDS.index(name)])
+
+    def keys(self):
+        return self.arrays.keys()
+
+    def __getitem__(self, key):
+        if not self.is_current():
+            raise RuntimeError("Shared map was reallocated, attach with a new descriptor")
+        count = self.get_count(BLOCK_COUNTS[key.split('.')[0]])
+        return self.arrays[key][:count]
+
+    def close(self):
+        # views from this SharedMap must not be used after this
+        self.arrays = {}
+        self.header = None
+        for shm in self.shms:
+            shm.close()
+        self.header_shm.close()
+        self.shms = []
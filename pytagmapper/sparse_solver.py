@@ -0,0 +1,129 @@
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+# solves the block sparse system
+#
+#  ⎡ H_aa   H_ab ⎤ ⎡x_a⎤   ⎡b_a⎤
+#  ⎣ H_ba   H_bb ⎦ ⎣x_b⎦ = ⎣b_b⎦
+#
+# where H_aa (A, da, da) and H_bb (B, db, db) are block diagonal
+# and H_ab is given as one (da, db) block per factor, coupling
+# variable a_idxs[i] with variable b_idxs[i]
+#
+# the a variables are eliminated with the schur complement
+#   S = H_bb - H_ba H_aa⁻¹ H_ab
+#   S x_b = b_b - H_ba H_aa⁻¹ b_a
+#   x_a = H_aa⁻¹ (b_a - H_ab x_b)
+# and the reduced system on b is solved as a sparse matrix
+
+def get_group_pairs(group_idxs):
+    # all (i, j) factor index pairs that share a group
+    # ie. the nonzero blocks of H_ba H_aa⁻¹ H_ab
+    order = np.argsort(group_idxs, kind='stable')
+    counts = np.bincount(group_idxs)
+    group_starts = np.cumsum(counts) - counts
+
+    sorted_groups = group_idxs[order]
+    pair_counts = counts[sorted_groups]
+    num_pairs = np.sum(pair_counts)
+    i = np.repeat(np.arange(len(order)), pair_counts)
+    offsets = np.arange(num_pairs) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+    j = group_starts[sorted_groups][i] + offsets
+    return order[i], order[j]
+
+def block_sparse_matrix(rows, cols, blocks, shape):
+    # assemble (N, d, d) blocks at block positions (rows, cols)
+    # duplicate positions are summed
+    N, dr, dc = blocks.shape
+    rows = (rows[:,None,None] * dr + np.arange(dr)[None,:,None]) + np.zeros((1,1,dc), dtype=np.int64)
+    cols = (cols[:,None,None] * dc + np.arange(dc)[None,None,:]) + np.zeros((1,dr,1), dtype=np.int64)
+    return scipy.sparse.coo_matrix(
+        (blocks.ravel(), (rows.ravel(), cols.ravel())),
+        shape=shape).tocsc()
+
+def get_schur_complement(H_aa, H_bb, H_ab, a_idxs, b_idxs, b_a, b_b):
+    # returns the reduced sparse system (S, rhs) on the b variables,
+    # the diagonal blocks of S, and H_aa⁻¹ for back substitution
+    B, db, _ = H_bb.shape
+
+    H_aa_inv = np.linalg.inv(H_aa)
+    W = H_aa_inv[a_idxs] @ H_ab # N x da x db
+
+    pair_i, pair_j = get_group_pairs(a_idxs)
+    reduction = H_ab[pair_i].transpose(0,2,1) @ W[pair_j]
+
+    S = block_sparse_matrix(
+        np.concatenate((np.arange(B), b_idxs[pair_i])),
+        np.concatenate((np.arange(B), b_idxs[pair_j])),
+        np.concatenate((H_bb, -reduction)),
+        (B*db, B*db))
+
+    S_diag = H_bb.copy()
+    on_diag = b_idxs[pair_i] == b_idxs[pair_j]
+    np.add.at(S_diag, b_idxs[pair_i][on_diag], -reduction[on_diag])
+
+    rhs = b_b.copy()
+    np.add.at(rhs, b_idxs, -W.transpose(0,2,1) @ b_a[a_idxs])
+    return S, rhs.reshape((B*db,)), S_diag, H_aa_inv
+
+def solve_reduced(S, rhs, S_diag, linear_solver = "direct"):
+    if linear_solver == "direct":
+        return scipy.sparse.linalg.spsolve(S, rhs)
+    elif linear_solver == "pcg":
+        # block jacobi preconditioner from the diagonal blocks of S
+        B, db, _ = S_diag.shape
+        diag_blocks_inv = np.linalg.inv(S_diag)
+        preconditioner = scipy.sparse.linalg.LinearOperator(
+            S.shape,
+            matvec = lambda x: (diag_blocks_inv @ x.reshape((B, db, 1))).ravel())
+        x, info = scipy.sparse.linalg.cg(S, rhs, M=preconditioner, maxiter=10*B*db)
+        if info < 0:
+            raise RuntimeError("pcg failed", info)
+        return x
+    else:
+        raise RuntimeError("Unsupported linear solver", linear_solver)
+
+def schur_solve(H_aa, H_bb, H_ab, a_idxs, b_idxs, b_a, b_b, linear_solver = "direct"):
+    # b_a is (A, da, 1), b_b is (B, db, 1)
+    # returns x_a (A, da, 1), x_b (B, db, 1)
+    B, db, _ = H_bb.shape
+    S, rhs, S_diag, H_aa_inv = get_schur_complement(H_aa, H_bb, H_ab, a_idxs, b_idxs, b_a, b_b)
+    x_b = solve_reduced(S, rhs, S_diag, linear_solver).reshape((B, db, 1))
+
+    r_a = b_a.copy()
+    np.add.at(r_a, a_idxs, -H_ab @ x_b[b_idxs])
+    x_a = H_aa_inv @ r_a
+    return x_a, x_b
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    A, B, da, db = 7, 5, 6, 3
+
+    # random factors, each coupling one a variable with one b variable
+    a_idxs = rng.integers(0, A, 30)
+    b_idxs = rng.integers(0, B, 30)
+    Js = rng.normal(size=(30, 8, da + db))
+    JtJs = Js.transpose(0,2,1) @ Js
+
+    H = np.eye(A*da + B*db)
+    for i in range(30):
+        a = slice(a_idxs[i]*da, (a_idxs[i]+1)*da)
+        b = slice(A*da + b_idxs[i]*db, A*da + (b_idxs[i]+1)*db)
+        H[a,a] += JtJs[i,:da,:da]
+        H[b,b] += JtJs[i,da:,da:]
+        H[a,b] += JtJs[i,:da,da:]
+        H[b,a] += JtJs[i,da:,:da]
+    rhs = rng.normal(size=(A*da + B*db, 1))
+    expected = np.linalg.solve(H, rhs)
+
+    H_aa = np.tile(np.eye(da), (A,1,1))
+    H_bb = np.tile(np.eye(db), (B,1,1))
+    np.add.at(H_aa, a_idxs, JtJs[:,:da,:da])
+    np.add.at(H_bb, b_idxs, JtJs[:,da:,da:])
+    for linear_solver in ["direct", "pcg"]:
+        x_a, x_b = schur_solve(H_aa, H_bb, JtJs[:,:da,da:], a_idxs, b_idxs,
+                               rhs[:A*da].reshape((A,da,1)), rhs[A*da:].reshape((B,db,1)),
+                               linear_solver)
+        actual = np.concatenate((x_a.ravel(), x_b.ravel()))
+        print(linear_solver, "schur solve vs dense solve", np.max(np.abs(actual - expected[:,0])))
@@ -0,0 +1,301 @@
+import numpy as np
+from pytagmapper.covisibility import CovisibilityIndex
+from pytagmapper.geometry import *
+from pytagmapper.map_builder import solvePnPWrapper
+from pytagmapper.project import get_corners_mat
+
+# hierarchical map building for scenes too big for one MapBuilder
+#
+#  1) cluster_viewpoints splits the viewpoints into groups that see
+#     the same tags
+#  2) every group is built into its own submap, each in its own frame
+#     (independent, so they can be built in parallel)
+#  3) merge_submaps chains the submaps together through the tags they
+#     have in common
+#
+#      submap A         submap B
+#     [v][v][v]        [v][v][v]
+#       \ | /            \ | /
+#    (t)(t)(t)(s)(s)  (s)(s)(t)(t)
+#               \_____/
+#            shared tags fix tx_world_B
+#
+#  4) add_posed_viewpoints puts everything into one MapBuilder at the
+#     aligned poses (like interactive_fuser does for separately built
+#     maps) for a final joint refinement
+
+def cluster_viewpoints(viewpoints, max_size):
+    # viewpoints is viewpoint_id => {tag_id => corners}
+    # returns a list of lists of viewpoint ids
+    #
+    # a cluster starts from the unassigned viewpoint with the most tags
+    # and grows by the viewpoint with the most tags in common with the
+    # cluster until it has max_size viewpoints
+    #
+    # leftover clusters under a quarter of max_size are folded into the
+    # cluster they have the most tags in common with, a tiny submap
+    # is poorly constrained and hard to align
+
+    # most tags first, so that is the seed of each cluster
+    by_num_tags = sorted(viewpoints.keys(), key=lambda viewpoint_id: -len(viewpoints[viewpoint_id]))
+    index = CovisibilityIndex({ viewpoint_id: viewpoints[viewpoint_id] for viewpoint_id in by_num_tags })
+
+    clusters = []
+    while len(index):
+        index.clear_map()
+        cluster = []
+        viewpoint_id = index.pop_best(min_overlap = 0)
+        while viewpoint_id is not None:
+            cluster.append(viewpoint_id)
+            index.add_viewpoint(viewpoint_id)
+            if len(cluster) >= max_size:
+                break
+            viewpoint_id = index.pop_best()
+        clusters.append(cluster)
+
+    cluster_tags = [set().union(*(viewpoints[viewpoint_id].keys() for viewpoint_id in cluster))
+                    for cluster in clusters]
+    for i in reversed(range(len(clusters))):
+        if len(clusters) == 1 or len(clusters[i]) >= max_size/4:
+            continue
+        j = max((j for j in range(len(clusters)) if j != i),
+                key=lambda j: len(cluster_tags[i] & cluster_tags[j]))
+        if not cluster_tags[i] & cluster_tags[j]:
+            continue
+        clusters[j] += clusters[i]
+        cluster_tags[j] |= cluster_tags[i]
+        del clusters[i]
+        del cluster_tags[i]
+
+    return clusters
+
+def get_submap(map_builder):
+    # the poses of a finished MapBuilder, small enough to send between processes
+    return {
+        'map_type': map_builder.map_type,
+        'viewpoint_ids': list(map_builder.viewpoint_ids),
+        'txs_world_viewpoint': map_builder.viewpoint_poses.array.copy(),
+        'tag_ids': list(map_builder.tag_ids),
+        'txs_world_tag': map_builder.tag_poses.array.copy(),
+    }
+
+def get_tag_corners(tx_world_tag, tag_side_length):
+    # (4,3) world coordinates of the tag corners
+    if tx_world_tag.shape == (3,3):
+        tx_world_tag = SE2_to_SE3(tx_world_tag)
+    return (tx_world_tag @ get_corners_mat(tag_side_length))[:3,:].T
+
+def fit_rigid_transform(src_points, dst_points, planar = False):
+    # least squares tx_dst_src for dst_points ~ tx_dst_src @ src_points
+    # the points are (N,3)
+    # planar only allows rotation about z, for 2d and 2.5d maps
+    src_mean = np.mean(src_points, axis=0)
+    dst_mean = np.mean(dst_points, axis=0)
+    src_centered = src_points - src_mean
+    dst_centered = dst_points - dst_mean
+
+    dim = 2 if planar else 3
+    cov = dst_centered[:,:dim].T @ src_centered[:,:dim]
+    u, _, vt = np.linalg.svd(cov)
+    fix = np.eye(dim)
+    fix[-1,-1] = np.sign(np.linalg.det(u @ vt)) or 1.0 # no reflections
+
+    tx_dst_src = np.eye(4)
+    tx_dst_src[:dim,:dim] = u @ fix @ vt
+    tx_dst_src[:3,3] = dst_mean - tx_dst_src[:3,:3] @ src_mean
+    return tx_dst_src
+
+def fit_tag_transform(src_corners, dst_corners, tag_sizes, planar = False):
+    # tx_dst_src from the (N,4,3) corners of N tags seen in both frames
+    #
+    # a weakly constrained submap can have a few tags that are way off
+    # (eg a flipped tag seen by one viewpoint), which would drag a plain
+    # least squares fit. every tag alone fixes the transform, so try
+    # each, keep the one that puts the most tags within a tag side
+    # length of where they should be, and refit on those tags
+    best_inliers = None
+    best_error = float('inf')
+    for k in range(len(src_corners)):
+        tx_dst_src = fit_rigid_transform(src_corners[k], dst_corners[k], planar)
+        moved = src_corners @ tx_dst_src[:3,:3].T + tx_dst_src[:3,3]
+        errors = np.max(np.linalg.norm(moved - dst_corners, axis=2), axis=1)
+        inliers = errors < tag_sizes
+        error = np.sum(errors[inliers])
+        if best_inliers is None or np.sum(inliers) > np.sum(best_inliers) or \
+           (np.sum(inliers) == np.sum(best_inliers) and error < best_error):
+            best_inliers = inliers
+            best_error = error
+
+    return fit_rigid_transform(src_corners[best_inliers].reshape((-1,3)),
+                               dst_corners[best_inliers].reshape((-1,3)), planar)
+
+def transform_submap(submap, tx_world_submap):
+    # returns txs_world_viewpoint, txs_world_tag
+    txs_world_viewpoint = tx_world_submap @ submap['txs_world_viewpoint']
+    fix_SE3_batch(txs_world_viewpoint)
+    if submap['map_type'] == '2d':
+        txs_world_tag = SE3_to_SE2(tx_world_submap) @ submap['txs_world_tag']
+        fix_SE2_batch(txs_world_tag)
+    else:
+        txs_world_tag = tx_world_submap @ submap['txs_world_tag']
+        fix_SE3_batch(txs_world_tag)
+    return txs_world_viewpoint, txs_world_tag
+
+def align_submaps(submaps, tag_side_lengths):
+    # puts all submaps into the frame of the biggest one
+    # returns viewpoint_id => tx_world_viewpoint and
+    # tag_id => list of tx_world_tag, one from each submap with the tag
+    #
+    # submaps are added in order of most tags in common with the
+    # submaps already placed, and each is fit to the corners of those
+    # common tags (see fit_tag_transform) as placed by the first submap
+    # that had them
+    default_tag_side_length = tag_side_lengths["default"]
+    txs_world_viewpoint = {}
+    txs_world_tag = {}
+    tag_candidates = {}
+
+    remaining = sorted(range(len(submaps)), key=lambda i: -len(submaps[i]['viewpoint_ids']))
+    while remaining:
+        best_i = max(remaining, key=lambda i: len(txs_world_tag.keys() & set(submaps[i]['tag_ids'])))
+        remaining.remove(best_i)
+        submap = submaps[best_i]
+        planar = submap['map_type'] != '3d'
+
+        src_corners = []
+        dst_corners = []
+        tag_sizes = []
+        for tag_idx, tag_id in enumerate(submap['tag_ids']):
+            if tag_id not in txs_world_tag:
+                continue
+            tag_side_length = tag_side_lengths.get(tag_id, default_tag_side_length)
+            src_corners.append(get_tag_corners(submap['txs_world_tag'][tag_idx], tag_side_length))
+            dst_corners.append(get_tag_corners(txs_world_tag[tag_id], tag_side_length))
+            tag_sizes.append(tag_side_length)
+
+        if src_corners:
+            tx_world_submap = fit_tag_transform(np.array(src_corners), np.array(dst_corners), np.array(tag_sizes), planar)
+        else:
+            if txs_world_tag:
+                print("Submap has no tags in common with the rest of the map!")
+            tx_world_submap = np.eye(4)
+
+        submap_txs_world_viewpoint, submap_txs_world_tag = transform_submap(submap, tx_world_submap)
+        for viewpoint_id, tx_world_viewpoint in zip(submap['viewpoint_ids'], submap_txs_world_viewpoint):
+            txs_world_viewpoint[viewpoint_id] = tx_world_viewpoint
+        for tag_id, tx_world_tag in zip(submap['tag_ids'], submap_txs_world_tag):
+            txs_world_tag.setdefault(tag_id, tx_world_tag)
+            tag_candidates.setdefault(tag_id, []).append(tx_world_tag)
+
+    return txs_world_viewpoint, tag_candidates
+
+def get_reprojection_error(camera_matrix, tx_world_viewpoint, world_points, image_points):
+    # mean pixel error of (N,3) world points against (N,2) image points
+    tx_viewpoint_world = SE3_inv(tx_world_viewpoint)
+    camera_points = world_points @ tx_viewpoint_world[:3,:3].T + tx_viewpoint_world[:3,3]
+    if np.any(camera_points[:,2] <= 0):
+        return float('inf')
+    projections = camera_points @ np.array(camera_matrix).T
+    projections = projections[:,:2] / projections[:,2:]
+    return np.mean(np.linalg.norm(projections - image_points, axis=1))
+
+def fit_viewpoint(camera_matrix, tags, tx_world_viewpoint, txs_world_tag, tag_side_lengths):
+    # returns tx_world_viewpoint, error
+    # either the given pose or a pnp fit to the tags, whichever
+    # reprojects the tags better
+    default_tag_side_length = tag_side_lengths["default"]
+    world_points = []
+    image_points = []
+    for tag_id, tag_corners in tags.items():
+        tag_side_length = tag_side_lengths.get(tag_id, default_tag_side_length)
+        world_points.append(get_tag_corners(txs_world_tag[tag_id], tag_side_length))
+        image_points.append(np.array(tag_corners).reshape((4,2)))
+    world_points = np.vstack(world_points)
+    image_points = np.vstack(image_points)
+
+    error = get_reprojection_error(camera_matrix, tx_world_viewpoint, world_points, image_points)
+    try:
+        tx_world_viewpoint_pnp = SE3_inv(solvePnPWrapper(world_points, image_points, camera_matrix))
+    except RuntimeError:
+        return tx_world_viewpoint, error
+    error_pnp = get_reprojection_error(camera_matrix, tx_world_viewpoint_pnp, world_points, image_points)
+    if error_pnp < error:
+        return tx_world_viewpoint_pnp, error_pnp
+    return tx_world_viewpoint, error
+
+def merge_submaps(camera_matrix, viewpoints, submaps, tag_side_lengths, max_pixel_error = 100):
+    # returns dicts viewpoint_id => tx_world_viewpoint, tag_id => tx_world_tag
+    # for the whole map, ready for add_posed_viewpoints
+    #
+    # a weakly constrained submap can get a tag flipped (a tag seen by a
+    # single viewpoint reprojects just as well flipped), so the merged
+    # poses are picked by how well they agree with everything else
+    #  - tags seen by several submaps take the candidate pose that lets
+    #    the viewpoints seeing the tag fit their detections best
+    #  - viewpoints take either their aligned submap pose or a pnp fit to
+    #    the merged tags (see fit_viewpoint)
+    txs_world_viewpoint, tag_candidates = align_submaps(submaps, tag_side_lengths)
+
+    tag_viewpoints = {}
+    for viewpoint_id in txs_world_viewpoint:
+        for tag_id in viewpoints[viewpoint_id]:
+            tag_viewpoints.setdefault(tag_id, []).append(viewpoint_id)
+
+    txs_world_tag = { tag_id: candidates[0] for tag_id, candidates in tag_candidates.items() }
+    for tag_id, candidates in tag_candidates.items():
+        if len(candidates) == 1:
+            continue
+        best_error = float('inf')
+        best_tx_world_tag = candidates[0]
+        for tx_world_tag in candidates:
+            txs_world_tag[tag_id] = tx_world_tag
+            error = 0
+            for viewpoint_id in tag_viewpoints[tag_id]:
+                viewpoint_error = fit_viewpoint(camera_matrix, viewpoints[viewpoint_id], txs_world_viewpoint[viewpoint_id],
+                                                txs_world_tag, tag_side_lengths)[1]
+                # capped, a viewpoint that also sees some other bad tag
+                # should not make every candidate look the same
+                error += min(viewpoint_error, max_pixel_error)
+            if error < best_error:
+                best_error = error
+                best_tx_world_tag = tx_world_tag
+        txs_world_tag[tag_id] = best_tx_world_tag
+
+    for viewpoint_id, tx_world_viewpoint in txs_world_viewpoint.items():
+        txs_world_viewpoint[viewpoint_id], _ = fit_viewpoint(
+            camera_matrix, viewpoints[viewpoint_id], tx_world_viewpoint, txs_world_tag, tag_side_lengths)
+
+    return txs_world_viewpoint, txs_world_tag
+
+def add_posed_viewpoints(map_builder, viewpoints, viewpoint_ids, txs_world_viewpoint, txs_world_tag):
+    # adds viewpoints to the map builder at known poses, without any
+    # pnp initialization, call map_builder.relinearize() afterwards
+    init_tags = dict(txs_world_tag)
+    for viewpoint_id in viewpoint_ids:
+        map_builder.add_viewpoint(viewpoint_id, viewpoints[viewpoint_id],
+                                  init_viewpoint = txs_world_viewpoint[viewpoint_id],
+                                  init_tags = init_tags)
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+
+    # fit_rigid_transform recovers a known transform
+    points = rng.normal(size=(12,3))
+    tx = se3_exp(rng.normal(size=(6,1)))
+    moved = (tx[:3,:3] @ points.T).T + tx[:3,3]
+    print("3d fit error", np.max(np.abs(fit_rigid_transform(points, moved) - tx)))
+
+    tx = xyt_to_SE3(rng.normal(size=(3,1)))
+    tx[2,3] = 0.3
+    moved = (tx[:3,:3] @ points.T).T + tx[:3,3]
+    print("planar fit error", np.max(np.abs(fit_rigid_transform(points, moved, planar=True) - tx)))
+
+    # two chains of viewpoints that only share tag 5
+    viewpoints = {}
+    for i in range(6):
+        viewpoints[f"a{i}"] = {i: None, i+1: None}
+        viewpoints[f"b{i}"] = {5+i: None, 6+i: None}
+    clusters = cluster_viewpoints(viewpoints, 6)
+    print("clusters", clusters)
+    assert sorted(sum(clusters, [])) == sorted(viewpoints.keys())
+    assert len(clusters) == 2
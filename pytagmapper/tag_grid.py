@@ -0,0 +1,149 @@
+import numpy as np
+from pytagmapper.geometry import SE3_inv
+
+# which tags of a map can be in view
+#
+# every tag is a sphere (center, radius) around its corners, and the
+# tags are bucketed into a uniform grid on their centers, about
+# tags_per_cell tags per occupied cell. each occupied cell keeps the
+# box around the spheres of its tags
+#
+#   cell => rows of its tags, box
+#
+# a query with the planes of a view frustum first drops every cell
+# whose box is outside of one of the planes, then tests only the tags
+# of the remaining cells, so a view of a small part of a large map
+# only touches the tags close to it
+#
+#   grid = TagGrid(world_corners) # (T, 4, 3)
+#   planes = get_frustum_planes(camera_matrix, (width, height), tx_world_viewpoint)
+#   rows = grid.query(planes)
+
+def get_frustum_planes(camera_matrix, image_size, tx_world_viewpoint, near = 0.0):
+    # the planes through the camera center and each image edge, and the
+    # near plane, in world coordinates
+    # returns (5, 4) planes [n, d], a point x is inside when n.x + d >= 0
+    width, height = image_size
+    image_corners = np.array([
+        [0, 0, 1],
+        [width, 0, 1],
+        [width, height, 1],
+        [0, height, 1],
+    ], dtype=np.float64)
+    rays = image_corners @ np.linalg.inv(camera_matrix).T # 4 x 3
+    center_ray = np.linalg.inv(camera_matrix) @ np.array([width/2, height/2, 1])
+
+    planes = np.zeros((5,4))
+    for i in range(4):
+        normal = np.cross(rays[i], rays[(i+1)%4])
+        if normal @ center_ray < 0:
+            normal = -normal
+        planes[i,:3] = normal / np.linalg.norm(normal)
+    planes[4] = [0, 0, 1, -near]
+
+    # x_viewpoint = R x_world + t, so n.x_viewpoint + d = (Rᵀn).x_world + (n.t + d)
+    tx_viewpoint_world = SE3_inv(tx_world_viewpoint)
+    R = tx_viewpoint_world[:3,:3]
+    t = tx_viewpoint_world[:3,3]
+    world_planes = np.empty((5,4))
+    world_planes[:,:3] = planes[:,:3] @ R
+    world_planes[:,3] = planes[:,:3] @ t + planes[:,3]
+    return world_planes
+
+class TagGrid:
+    def __init__(self, world_corners, tags_per_cell = 16):
+        # world_corners is (T, 4, 3)
+        self.centers = np.mean(world_corners, axis=1)
+        self.radii = np.max(np.linalg.norm(world_corners - self.centers[:,None,:], axis=2), axis=1)
+        num_tags = len(self.centers)
+        if num_tags == 0:
+            self.rows = np.zeros(0, dtype=np.int64)
+            self.cell_starts = np.zeros(1, dtype=np.int64)
+            self.cell_mins = np.zeros((0,3))
+            self.cell_maxs = np.zeros((0,3))
+            return
+
+        # cells sized so that the map spans about num_tags/tags_per_cell
+        # of them, counting only the axes the map actually extends along
+        # (a flat map is a 2d grid)
+        origin = np.min(self.centers, axis=0)
+        extents = np.max(self.centers, axis=0) - origin
+        spread = extents > 1e-6 * max(np.max(extents), 1e-12)
+        num_cells = max(num_tags / tags_per_cell, 1)
+        if np.any(spread):
+            self.cell_size = (np.prod(extents[spread]) / num_cells) ** (1/np.count_nonzero(spread))
+        else:
+            self.cell_size = 1.0
+        self.cell_size = max(self.cell_size, 1e-9)
+
+        cells = np.floor((self.centers - origin) / self.cell_size).astype(np.int64)
+        _, cell_idxs = np.unique(cells, axis=0, return_inverse=True)
+        cell_idxs = cell_idxs.reshape(-1)
+        self.rows = np.argsort(cell_idxs, kind='stable')
+        counts = np.bincount(cell_idxs)
+        self.cell_starts = np.concatenate(([0], np.cumsum(counts)))
+
+        sorted_mins = (self.centers - self.radii[:,None])[self.rows]
+        sorted_maxs = (self.centers + self.radii[:,None])[self.rows]
+        self.cell_mins = np.minimum.reduceat(sorted_mins, self.cell_starts[:-1], axis=0)
+        self.cell_maxs = np.maximum.reduceat(sorted_maxs, self.cell_starts[:-1], axis=0)
+
+    def query(self, planes):
+        # rows of the tags whose spheres are not fully outside of any of
+        # the (P, 4) planes, in increasing order
+        if len(self.cell_mins) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # the corner of each box furthest along each plane normal
+        normals = planes[:,:3]
+        furthest = np.where(normals[None,:,:] >= 0, self.cell_maxs[:,None,:], self.cell_mins[:,None,:]) # C x P x 3
+        cells_inside = np.all(np.sum(furthest * normals, axis=2) + planes[:,3] >= 0, axis=1)
+
+        cells = np.nonzero(cells_inside)[0]
+        if len(cells) == 0:
+            return np.zeros(0, dtype=np.int64)
+        starts = self.cell_starts[cells]
+        counts = self.cell_starts[cells + 1] - starts
+        offsets = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows = self.rows[np.repeat(starts, counts) + offsets]
+
+        distances = self.centers[rows] @ normals.T + planes[:,3] # N x P
+        rows = rows[np.all(distances >= -self.radii[rows,None], axis=1)]
+        return np.sort(rows)
+
+if __name__ == "__main__":
+    from pytagmapper.geometry import se3_exp
+    from pytagmapper.project import project_points
+
+    # against testing every tag
+    rng = np.random.default_rng(0)
+    camera_matrix = np.array([[600, 0, 320], [0, 600, 240], [0, 0, 1]], dtype=np.float64)
+    for flat in [True, False]:
+        centers = rng.uniform(0, 10, size=(3000,3))
+        if flat:
+            centers[:,2] = 0
+        world_corners = centers[:,None,:] + rng.normal(size=(3000,4,3)) * 0.03
+        grid = TagGrid(world_corners)
+
+        for i in range(20):
+            tx_world_viewpoint = np.array([
+                [1,  0,  0, rng.uniform(0, 10)],
+                [0, -1,  0, rng.uniform(0, 10)],
+                [0,  0, -1, rng.uniform(0.5, 3)],
+                [0,  0,  0, 1],
+            ]) @ se3_exp(np.concatenate((rng.normal(size=3) * 0.5, [0, 0, 0]))[:,None])
+            planes = get_frustum_planes(camera_matrix, (640, 480), tx_world_viewpoint)
+            rows = grid.query(planes)
+
+            distances = grid.centers @ planes[:,:3].T + planes[:,3]
+            expected = np.nonzero(np.all(distances >= -grid.radii[:,None], axis=1))[0]
+            assert np.array_equal(rows, expected), (rows, expected)
+
+            # and every tag with a corner in the image is in there
+            tx_viewpoint_world = SE3_inv(tx_world_viewpoint)
+            camera_corners = world_corners @ tx_viewpoint_world[:3,:3].T + tx_viewpoint_world[:3,3]
+            image_corners, _ = project_points(camera_matrix, camera_corners)
+            in_image = np.all(camera_corners[...,2] > 0, axis=1) & np.any(
+                np.all((image_corners >= 0) & (image_corners <= [640, 480]), axis=2), axis=1)
+            assert np.all(np.isin(np.nonzero(in_image)[0], rows))
+        print("flat" if flat else "3d", "cells", len(grid.cell_mins), "matched testing every tag")
@@ -4,8 +4,17 @@ import random
 from pytagmapper import data
 from pytagmapper import project
 from pytagmapper.geometry import *
+from pytagmapper.checkpoint import save_checkpoint, load_checkpoint
+from pytagmapper.convergence import ConvergenceController
+from pytagmapper.covariance import get_marginal_covariances
+from pytagmapper.covisibility import CovisibilityIndex
 from pytagmapper.map_builder import MapBuilder
+from pytagmapper.parallel import ParallelMessagePasser
+from pytagmapper.submaps import cluster_viewpoints, get_submap, merge_submaps, add_posed_viewpoints
+import multiprocessing
+import os
 import sys
+import time
 
 import cv2
 import numpy as np
@@ -20,57 +29,102 @@ def solvePnPWrapper(obj_points, img_points, camera_matrix):
     tx_camera_obj[:3,3:4] = tvec
     return tx_camera_obj
 
-def add_viewpoint(source_data, viewpoint_id, map_builder, total_viewpoints):
-    viewpoint = source_data['viewpoints'][viewpoint_id]
+def optimize_step(map_builder, message_passer = None):
+    if map_builder.scheduling == "residual":
+        # at most about one update per variable
+        max_updates = len(map_builder.viewpoint_ids) + len(map_builder.tag_ids)
+        return map_builder.update_scheduled(max_updates)
+    if message_passer is not None:
+        message_passer.sweep(20)
+    elif map_builder.solver == "gbp":
+        for i in range(20):
+            map_builder.send_detection_to_viewpoint_msgs()
+            map_builder.send_detection_to_tag_msgs()
+    return map_builder.update()
 
-    map_builder.add_viewpoint(viewpoint_id,
-                              viewpoint)
+def make_convergence(args, final = False):
+    # by default the same heuristics as always, --batch adds budgets so
+    # that every loop ends on its own
+    if final:
+        convergence = ConvergenceController(target_error=0.1, rtol=1e-4, min_its=3, min_rtol=1e-5)
+    else:
+        convergence = ConvergenceController(target_error=0.5, rtol=1e-3, min_its=4)
 
-    map_builder.relinearize()
+    if args.batch:
+        convergence.stall_its = 20
+        convergence.max_its = 1000 if final else 200
 
-    error = map_builder.get_avg_detection_error()
-    change_pct = 1
-    improved = False
-    num_its = 0
+    if args.rtol is not None:
+        convergence.rtol = args.rtol
+    if args.atol is not None:
+        convergence.atol = args.atol
+    if args.stall_its is not None:
+        convergence.stall_its = args.stall_its
+    if args.max_its is not None:
+        convergence.max_its = args.max_its
+    if args.max_seconds is not None:
+        convergence.max_seconds = args.max_seconds
+    return convergence
 
+def run_convergence(map_builder, convergence, label, message_passer = None, batch = False,
+                    checkpoint = None, convergence_state = None):
+    # checkpoint(convergence) is called after every step, and a
+    # convergence_state saved by an earlier run continues that loop
+    # instead of starting a new one
+    if convergence_state is None:
+        convergence.start(map_builder.get_avg_detection_error())
+    else:
+        convergence.set_state(convergence_state)
     try:
-        while (improved and change_pct >= 1e-3) or error >= 0.5 or num_its <= 3:
-            print(f"[{len(map_builder.viewpoint_ids)}/{total_viewpoints}] change {change_pct*100:#.4g}% error {error:#.4g}\r", end='')            
-            sys.stdout.flush()
-            prev_error = error
-            for i in range(20):
-                map_builder.send_detection_to_viewpoint_msgs()
-                map_builder.send_detection_to_tag_msgs()
-            improved = map_builder.update()
-            error = map_builder.get_avg_detection_error()
-            delta = max(prev_error - error, 0)
-            change_pct = delta/prev_error
-            num_its += 1
-
+        while not convergence.done:
+            if not batch:
+                print(f"[{label}] change {convergence.change*100:#.4g}% error {convergence.error:#.4g}\r", end='')
+                sys.stdout.flush()
+            improved = optimize_step(map_builder, message_passer)
+            convergence.update(map_builder.get_avg_detection_error(), improved)
+            if checkpoint is not None:
+                checkpoint(convergence)
     except KeyboardInterrupt:
-        pass
-    
-    return map_builder
+        convergence.stop("skipped")
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Cluster images based on shared tags")
-    parser.add_argument('directory', type=str, help='scene data directory')
-    parser.add_argument('--output-dir', '-o', type=str, help='output data directory', default='')
-    parser.add_argument('--mode', type=str, default='3d', help='2d, 2.5d, or 3d (default 3d)')
-    args = parser.parse_args()
+    if batch:
+        print(f"[{label}] {convergence.num_its} iterations error {convergence.error:#.4g} ({convergence.reason})")
+    return convergence
 
-    if args.mode not in ['2.5d', '3d', '2d']:
-        raise RuntimeError("Unexpected map type", args.mode)
+def add_viewpoint(source_data, viewpoint_id, map_builder, total_viewpoints, message_passer = None,
+                  convergence = None, batch = False):
+    # returns the convergence controller after optimizing the new viewpoint
+    viewpoint = source_data['viewpoints'][viewpoint_id]
 
-    output_dir = args.output_dir or args.directory
-    scene_data = data.load_data(args.directory)
+    # keeps the messages of the rest of the map
+    # and only linearizes the new detections
+    map_builder.insert_viewpoint(viewpoint_id,
+                                 viewpoint)
 
+    if convergence is None:
+        convergence = ConvergenceController(target_error=0.5, rtol=1e-3, min_its=4)
+    label = f"{len(map_builder.viewpoint_ids)}/{total_viewpoints}"
+    if batch:
+        label += f" viewpoint {viewpoint_id}"
+    return run_convergence(map_builder, convergence, label, message_passer, batch)
+
+def build_incremental(scene_data, viewpoint_ids, map_builder, message_passer = None,
+                      convergence = None, batch = False, iteration_counts = None, checkpoint = None):
+    # adds the viewpoints one at a time, starting from the one with the
+    # most tags and then always the one with the most overlap with the map
+    # returns a list of (viewpoint_id, iterations, stop reason)
+    #
+    # a map_builder that already has viewpoints (eg from a checkpoint) is
+    # continued, checkpoint(iteration_counts) is called after each viewpoint
     viewpoints = scene_data['viewpoints']
-    viewpoint_ids = list(viewpoints.keys())
-    random.shuffle(viewpoint_ids)
-    # print(f"viewpoint ids {viewpoint_ids}")
+    index = CovisibilityIndex({ viewpoint_id: viewpoints[viewpoint_id] for viewpoint_id in viewpoint_ids })
+    iteration_counts = list(iteration_counts or [])
 
-    used_viewpoints = set()
+    for viewpoint_id in map_builder.viewpoint_ids:
+        index.add_viewpoint(viewpoint_id)
+    if map_builder.viewpoint_ids:
+        return continue_incremental(scene_data, viewpoint_ids, map_builder, index, message_passer,
+                                    convergence, batch, iteration_counts, checkpoint)
 
     # get the image with the most tags
     best_viewpoint = 0
@@ -83,71 +137,229 @@ if __name__ == "__main__":
     # print("best viewpoint was ", best_viewpoint)
     # print("best num tags ", best_num_tags)
 
-    map_builder = MapBuilder(scene_data['camera_matrix'],
-                             scene_data['tag_side_lengths'],
-                             args.mode)
-
     map_builder.add_viewpoint(best_viewpoint,
-                              scene_data['viewpoints'][best_viewpoint])
+                              viewpoints[best_viewpoint])
     map_builder.relinearize()
-    used_viewpoints.add(best_viewpoint)
-
-    print("Optimizing viewpoint. ctrl+c to skip.")
-
-    while viewpoints.keys() - used_viewpoints:
-        # find the viewpoint with the most overlap with the map
-        best_viewpoint = -1
-        best_overlap = {}
-        for viewpoint_id in viewpoint_ids:
-            if viewpoint_id in used_viewpoints:
-                continue
-            overlap = viewpoints[viewpoint_id].keys() & map_builder.tag_id_to_idx.keys()
-            if len(overlap) > len(best_overlap):
-                best_overlap = overlap
-                best_viewpoint = viewpoint_id
-
-        # print("best overlap from viewpoint", best_viewpoint, "of len", len(best_overlap))
-        add_viewpoint(scene_data, best_viewpoint, map_builder, len(scene_data['viewpoints']))
-        used_viewpoints.add(best_viewpoint)
-
-    error = map_builder.get_avg_detection_error()
-    change_pct = 1
-    improved = False
-    num_its = 0
-    try:
-        while (improved and change_pct >= 1e-4) or error >= 0.1 or num_its < 3:
-            print(f"[final] change {change_pct*100:#.4g}% error {error:#.4g}\r", end='')
-            sys.stdout.flush()
-            prev_error = error
-            for i in range(20):
-                map_builder.send_detection_to_viewpoint_msgs()
-                map_builder.send_detection_to_tag_msgs()
-            improved = map_builder.update()
-            error = map_builder.get_avg_detection_error()
-            delta = max(prev_error - error, 0)
-            change_pct = delta/prev_error
-            num_its += 1
-
-            if (improved and change_pct <= 1e-5):
-                # give up
-                break
-    except KeyboardInterrupt:
+    index.add_viewpoint(best_viewpoint)
+    iteration_counts.append((best_viewpoint, 0, "first"))
+
+    return continue_incremental(scene_data, viewpoint_ids, map_builder, index, message_passer,
+                                convergence, batch, iteration_counts, checkpoint)
+
+def continue_incremental(scene_data, viewpoint_ids, map_builder, index, message_passer,
+                         convergence, batch, iteration_counts, checkpoint):
+    while len(index):
+        if checkpoint is not None:
+            checkpoint(iteration_counts)
+
+        # the viewpoint with the most overlap with the map
+        best_viewpoint = index.pop_best(min_overlap = 0)
+        viewpoint_convergence = add_viewpoint(scene_data, best_viewpoint, map_builder, len(viewpoint_ids),
+                                              message_passer, convergence, batch)
+        iteration_counts.append((best_viewpoint, viewpoint_convergence.num_its, viewpoint_convergence.reason))
+        index.add_viewpoint(best_viewpoint)
+
+    return iteration_counts
+
+def refine(map_builder, message_passer = None, convergence = None, batch = False, checkpoint = None,
+           convergence_state = None):
+    if convergence is None:
+        convergence = ConvergenceController(target_error=0.1, rtol=1e-4, min_its=3, min_rtol=1e-5)
+    return run_convergence(map_builder, convergence, "final", message_passer, batch, checkpoint,
+                           convergence_state)
+
+class BuildCheckpointer:
+    # saves the map builder and the build progress to path
+    # at most every interval seconds, see checkpoint.py
+    #
+    # the incremental phase is saved between viewpoints, the final
+    # refinement also saves its convergence state so that its budgets
+    # carry over a resume
+    def __init__(self, path, interval, viewpoint_order):
+        self.path = path
+        self.interval = interval
+        self.viewpoint_order = viewpoint_order
+        self.last_save_time = time.time()
+
+    def save(self, map_builder, phase, iteration_counts, convergence = None):
+        save_checkpoint(self.path, map_builder, {
+            'phase': phase,
+            'viewpoint_order': self.viewpoint_order,
+            'iteration_counts': iteration_counts,
+            'convergence': convergence.get_state() if convergence is not None else None,
+        })
+        self.last_save_time = time.time()
+
+    def maybe_save(self, map_builder, phase, iteration_counts, convergence = None):
+        if self.interval > 0 and time.time() - self.last_save_time >= self.interval:
+            self.save(map_builder, phase, iteration_counts, convergence)
+
+def print_iteration_counts(iteration_counts):
+    num_its = [its for _, its, _ in iteration_counts]
+    reasons = {}
+    for _, _, reason in iteration_counts:
+        reasons[reason] = reasons.get(reason, 0) + 1
+    worst_viewpoint, worst_its, _ = max(iteration_counts, key=lambda count: count[1])
+    print(f"Iterations per viewpoint: total {sum(num_its)} mean {np.mean(num_its):#.4g} max {worst_its} (viewpoint {worst_viewpoint})")
+    print("Stopped by", ", ".join(f"{reason} {count}" for reason, count in sorted(reasons.items())))
+
+def make_map_builder(scene_data, args, shared_memory = False):
+    return MapBuilder(scene_data['camera_matrix'],
+                      scene_data['tag_side_lengths'],
+                      args.mode,
+                      message_passing=args.message_passing,
+                      solver=args.solver,
+                      scheduling=args.scheduling,
+                      shared_memory=shared_memory,
+                      gauge=args.gauge)
+
+def build_submap(job):
+    # builds one submap from scratch, can run in a worker process
+    scene_data, viewpoint_ids, args = job
+    map_builder = make_map_builder(scene_data, args)
+    iteration_counts = build_incremental(scene_data, viewpoint_ids, map_builder,
+                                         convergence=make_convergence(args), batch=args.batch)
+    refine(map_builder, convergence=make_convergence(args, final=True), batch=args.batch)
+    submap = get_submap(map_builder)
+    submap['iteration_counts'] = iteration_counts
+    return submap
+
+def build_submaps(scene_data, clusters, args):
+    jobs = []
+    for viewpoint_ids in clusters:
+        submap_data = dict(scene_data)
+        submap_data['viewpoints'] = { viewpoint_id: scene_data['viewpoints'][viewpoint_id] for viewpoint_id in viewpoint_ids }
+        jobs.append((submap_data, viewpoint_ids, args))
+
+    if args.workers <= 1:
+        return [build_submap(job) for job in jobs]
+
+    with multiprocessing.Pool(args.workers) as pool:
+        result = pool.map_async(build_submap, jobs)
+        while True:
+            try:
+                return result.get()
+            except KeyboardInterrupt:
+                # the workers got the ctrl+c as well and skip ahead
+                pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cluster images based on shared tags")
+    parser.add_argument('directory', type=str, help='scene data directory')
+    parser.add_argument('--output-dir', '-o', type=str, help='output data directory', default='')
+    parser.add_argument('--mode', type=str, default='3d', help='2d, 2.5d, or 3d (default 3d)')
+    parser.add_argument('--message-passing', type=str, default='sequential', help='sequential or synchronous (default sequential)')
+    parser.add_argument('--solver', type=str, default='gbp', help='gbp or lm (default gbp)')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes for the gbp message passing, or for building submaps (default 1)')
+    parser.add_argument('--gauge', type=str, default='recenter', help='recenter or anchor (default recenter), anchor holds the first tag fixed instead of moving the whole map after every update')
+    parser.add_argument('--scheduling', type=str, default='sweep', help='sweep or residual (default sweep), residual only updates the parts of the map that are still moving')
+    parser.add_argument('--submap-size', type=int, default=0, help='build the map out of submaps of about this many viewpoints, which are then aligned and refined together (default 0, no submaps)')
+    parser.add_argument('--batch', action='store_true', help='non-interactive, log one line per viewpoint and stop every optimization loop on its own (by default after 200 iterations per viewpoint, 1000 for the final refinement, or 20 iterations without progress)')
+    parser.add_argument('--max-its', type=int, default=None, help='maximum optimization iterations per viewpoint and for the final refinement')
+    parser.add_argument('--max-seconds', type=float, default=None, help='maximum seconds of optimization per viewpoint and for the final refinement')
+    parser.add_argument('--rtol', type=float, default=None, help='converged once the error is low and improves by less than this fraction (default 1e-3 per viewpoint, 1e-4 final)')
+    parser.add_argument('--atol', type=float, default=None, help='converged once the average detection error is at most this (default 0)')
+    parser.add_argument('--stall-its', type=int, default=None, help='give up after this many iterations without progress (default off, 20 with --batch)')
+    parser.add_argument('--checkpoint', type=str, default='', help='checkpoint file (default checkpoint.npz in the output directory)')
+    parser.add_argument('--checkpoint-interval', type=float, default=0, help='save a checkpoint at most every this many seconds (default 0, no checkpoints)')
+    parser.add_argument('--resume', action='store_true', help='continue the build saved in the checkpoint file')
+    parser.add_argument('--covariances', action='store_true', help='also save the uncertainty of every tag and viewpoint to covariances.json')
+    args = parser.parse_args()
+
+    if args.mode not in ['2.5d', '3d', '2d']:
+        raise RuntimeError("Unexpected map type", args.mode)
+
+    parallel_message_passing = args.solver == 'gbp' and args.scheduling == 'sweep'
+    if args.workers > 1 and not args.submap_size and not parallel_message_passing:
+        raise RuntimeError("--workers needs --solver gbp and --scheduling sweep")
+    parallel_message_passing = parallel_message_passing and args.workers > 1
+
+    output_dir = args.output_dir or args.directory
+    scene_data = data.load_data(args.directory)
+    checkpoint_path = args.checkpoint or os.path.join(output_dir, "checkpoint.npz")
+
+    viewpoints = scene_data['viewpoints']
+    if args.resume:
+        # the map builder settings (mode, solver, ...) come from the checkpoint
+        map_builder, progress = load_checkpoint(checkpoint_path, shared_memory=parallel_message_passing)
+        phase = progress['phase']
+        viewpoint_ids = progress['viewpoint_order']
+        iteration_counts = [tuple(count) for count in progress['iteration_counts']]
+        convergence_state = progress.get('convergence')
+        if args.submap_size > 0 and phase != "final":
+            # submap builds are only checkpointed once the submaps are merged
+            raise RuntimeError("--resume with --submap-size needs a checkpoint from the final refinement, not from", phase)
+        if parallel_message_passing and (map_builder.solver, map_builder.scheduling) != ('gbp', 'sweep'):
+            raise RuntimeError("--workers needs a checkpoint saved with --solver gbp and --scheduling sweep")
+        print(f"Resuming from {checkpoint_path} with {len(map_builder.viewpoint_ids)}/{len(viewpoint_ids)} viewpoints")
+    else:
+        phase = "incremental"
+        viewpoint_ids = list(viewpoints.keys())
+        random.shuffle(viewpoint_ids)
+        # print(f"viewpoint ids {viewpoint_ids}")
+        iteration_counts = []
+        convergence_state = None
+        map_builder = make_map_builder(scene_data, args, shared_memory=parallel_message_passing)
+
+    checkpointer = BuildCheckpointer(checkpoint_path, args.checkpoint_interval, viewpoint_ids)
+
+    message_passer = None
+    if parallel_message_passing:
+        message_passer = ParallelMessagePasser(map_builder, args.workers)
+
+    if not args.batch:
+        print("Optimizing viewpoint. ctrl+c to skip.")
+
+    if phase == "final":
         pass
+    elif args.submap_size > 0:
+        clusters = cluster_viewpoints({ viewpoint_id: viewpoints[viewpoint_id] for viewpoint_id in viewpoint_ids },
+                                      args.submap_size)
+        print(f"Building {len(clusters)} submaps")
+        submaps = build_submaps(scene_data, clusters, args)
+        iteration_counts = sum((submap['iteration_counts'] for submap in submaps), [])
+
+        if not args.batch:
+            print("\r" + " "*100 + "\r", end='') # clear out the loading bar
+        print("Merging submaps")
+        txs_world_viewpoint, txs_world_tag = merge_submaps(scene_data['camera_matrix'], viewpoints,
+                                                           submaps, scene_data['tag_side_lengths'])
+        add_posed_viewpoints(map_builder, viewpoints, sum(clusters, []),
+                             txs_world_viewpoint, txs_world_tag)
+        map_builder.relinearize()
+    else:
+        iteration_counts = build_incremental(scene_data, viewpoint_ids, map_builder, message_passer,
+                                             make_convergence(args), args.batch, iteration_counts,
+                                             lambda iteration_counts: checkpointer.maybe_save(map_builder, "incremental", iteration_counts))
 
-    print("\r" + " "*100, end='') # clear out the loading bar
-    print("\rSaving to", output_dir)
+    if args.checkpoint_interval > 0 and phase != "final":
+        checkpointer.save(map_builder, "final", iteration_counts)
+    refine(map_builder, message_passer, make_convergence(args, final=True), args.batch,
+           lambda convergence: checkpointer.maybe_save(map_builder, "final", iteration_counts, convergence),
+           convergence_state)
+
+    if message_passer is not None:
+        message_passer.close()
+
+    if map_builder.gauge == "anchor":
+        map_builder.recenter()
+
+    if not args.batch:
+        print("\r" + " "*100 + "\r", end='') # clear out the loading bar
+    print_iteration_counts(iteration_counts)
+    print("Saving to", output_dir)
     data.save_viewpoints_json(
         output_dir,
         map_builder.viewpoint_ids,
         map_builder.txs_world_viewpoint)
 
-    if args.mode == '3d':
+    if map_builder.map_type == '3d':
         data.save_map3d_json(
             output_dir,
             map_builder.tag_side_lengths,
             map_builder.tag_ids,
             map_builder.txs_world_tag)
-    elif args.mode == '2.5d':
+    elif map_builder.map_type == '2.5d':
         data.save_map2p5d_json(
             output_dir,
             map_builder.tag_side_lengths,
@@ -158,4 +370,16 @@ if __name__ == "__main__":
             output_dir,
             map_builder.tag_side_lengths,
             map_builder.tag_ids,
-            map_builder.txs_world_tag)    
+            map_builder.txs_world_tag)
+
+    if args.covariances:
+        viewpoint_covs, tag_covs = get_marginal_covariances(map_builder)
+        data.save_covariances_json(
+            output_dir,
+            map_builder.map_type,
+            map_builder.tag_ids,
+            tag_covs,
+            map_builder.viewpoint_ids,
+            viewpoint_covs)
+
+    map_builder.close()
@@ -136,7 +136,7 @@ def main():
         if tracker_initted:
             improved = tracker.update(aruco_ids, aruco_corners_flat, force_update = True)
 
-        ptag_ids, ptag_corners = tracker.get_projections()
+        ptag_ids, ptag_corners = tracker.get_projections(image_size=(frame.shape[1], frame.shape[0]))
         for tag_id, acorners in zip(ptag_ids, ptag_corners):
             for i in range(4):
                 ni = (i+1)%4
@@ -151,8 +151,7 @@ if __name__ == "__main__":
            imgui.button("add image"):
             image_id = image_ids[next_image_idx]
             added_image_ids.append(image_id)
-            map_builder.add_viewpoint(image_id, data["viewpoints"][image_id])
-            map_builder.relinearize()
+            map_builder.insert_viewpoint(image_id, data["viewpoints"][image_id])
             next_image_idx += 1
 
         if optimize: